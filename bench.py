@@ -0,0 +1,410 @@
+# Slide Master AI Bot — oflayn benchmark
+#
+# Tarmoq, Telegram, Groq va PostgreSQL kerak emas: Telegram so'rovlari soxta
+# javob qaytaradi, AsyncGroq o'rniga deterministik stub, baza esa xotirada.
+#
+#   python bench.py                          # barcha bosqichlar
+#   python bench.py -k pptx -n 200           # faqat nomida "pptx" bo'lganlar
+#   python bench.py --save bench_baseline.json
+#   python bench.py --compare bench_baseline.json --threshold 0.15
+#
+# --compare bilan p50 yoki p99 bazaviy natijadan threshold'dan ko'proq sekinlashsa,
+# yoki xotira cho'qqisi shuncha oshsa, skript 1 kodi bilan tugaydi.
+import os
+import sys
+import gc
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tracemalloc
+from datetime import datetime
+
+# bot.py import paytida env tekshiradi — oflayn qiymatlar
+os.environ.setdefault('BOT_TOKEN', '123456:BENCHBENCHBENCHBENCHBENCHBENCHBENCH')
+os.environ.setdefault('GROQ_API_KEY', 'bench')
+os.environ.setdefault('DATABASE_URL', 'postgresql://bench@localhost/bench')
+os.environ.setdefault('GROQ_STREAM', '1')
+os.environ.setdefault('PROGRESS_EDIT_EVERY', '0')
+os.environ.setdefault('THROTTLE_ENABLED', '0')   # bitta foydalanuvchidan ketma-ket update'lar
+
+import logging
+logging.disable(logging.WARNING)
+
+import aiogram.bot.api
+from aiogram import Bot, Dispatcher, types
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+import bot as app
+
+BENCH_UID   = 100000
+LONG_POINT  = ("Ushbu bandda <muhim> & \"murakkab\" ma'lumotlar keltiriladi, "
+               "jumladan statistika, tarixiy faktlar va amaliy misollar. ") * 4
+
+# --- SOXTA MUHIT ---
+def make_outline(topic, num_slides, long_text=False):
+    point = LONG_POINT if long_text else "Qisqa va aniq fikr"
+    return {"slides": [
+        {"title": f"{topic}: {i + 1}-qism", "points": [f"{point} #{j}" for j in range(4)]}
+        for i in range(num_slides)
+    ]}
+
+def outline_response(topic, num_slides, long_text=False):
+    body = json.dumps(make_outline(topic, num_slides, long_text), ensure_ascii=False)
+    return f"Mana taqdimot:\n```json\n{body}\n```"
+
+def titles_response(topic, num_slides):
+    return json.dumps({"titles": [f"{topic}: {i + 1}-qism" for i in range(num_slides)]}, ensure_ascii=False)
+
+class _Obj:
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+class StubCompletions:
+    def __init__(self, chunk_size=24):
+        self.chunk_size = chunk_size
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        prompt = messages[-1]['content']
+        topic  = prompt.split('"')[1]
+        count  = int(prompt.split('Generate exactly ')[1].split()[0])
+        text   = titles_response(topic, count) if '"titles"' in prompt else outline_response(topic, count)
+        if not stream:
+            return _Obj(choices=[_Obj(message=_Obj(content=text))])
+        return self._stream(text)
+
+    async def _stream(self, text):
+        for i in range(0, len(text), self.chunk_size):
+            yield _Obj(choices=[_Obj(delta=_Obj(content=text[i:i + self.chunk_size]))])
+
+class FakeTelegram:
+    def __init__(self):
+        self.calls      = 0
+        self.message_id = 0
+
+    def _message(self, data):
+        self.message_id += 1
+        chat_id = int(data.get('chat_id') or BENCH_UID)
+        return {'message_id': self.message_id, 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': data.get('text', '')}
+
+    async def make_request(self, session, server, token, method, data=None, files=None, **kwargs):
+        self.calls += 1
+        data = data or {}
+        if method == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method == 'getChatMember':
+            return {'status': 'member', 'user': {'id': int(data['user_id']), 'is_bot': False,
+                                                 'first_name': 'Bench'}}
+        if method.startswith('send') or method == 'copyMessage':
+            return self._message(data)
+        return True
+
+class MemoryDatabase:
+    def __init__(self):
+        self.rows   = {}
+        self.ledger = []
+
+    def _row(self, user_id):
+        return {'id': user_id, 'username': 'bench', 'first_name': 'Bench', 'last_name': None,
+                'lang': 'uz', 'balance': 10 ** 9, 'is_premium': False, 'invited_by': None,
+                'created_at': datetime(2024, 1, 1), 'last_active': None}
+
+    async def get_user(self, user_id):
+        return self.rows.get(user_id)
+
+    async def add_user(self, user_id, username, first_name, last_name, referrer_id=None):
+        if user_id in self.rows:
+            return False
+        self.rows[user_id] = self._row(user_id)
+        return True
+
+    async def touch_users(self, user_ids, timestamps):
+        pass
+
+    async def update_balance(self, user_id, amount, reason='adjust', ref=None):
+        row = self.rows[user_id]
+        row['balance'] += amount
+        self.ledger.append((user_id, amount, reason, ref))
+        return row['balance']
+
+    async def debit(self, user_id, amount, reason='generation', ref=None):
+        row = self.rows[user_id]
+        if row['balance'] < amount:
+            return None
+        return await self.update_balance(user_id, -amount, reason, ref)
+
+    async def get_referral_count(self, user_id):
+        return 0
+
+    async def add_stats(self, *items):
+        pass
+
+    async def get_deck_file(self, deck_hash):
+        return None
+
+    async def save_deck_file(self, deck_hash, file_id, size):
+        pass
+
+    async def get_stats(self):
+        return {'total_users': len(self.rows), 'total_slides': 0, 'premium_users': 0}
+
+    def pool_stats(self):
+        return {'size': 0, 'idle': 0, 'max': 0}
+
+def install_fakes():
+    telegram = FakeTelegram()
+    aiogram.bot.api.make_request = telegram.make_request
+    app._groq = _Obj(chat=_Obj(completions=StubCompletions()))
+    app.db = MemoryDatabase()
+    app.dp.storage = MemoryStorage()
+    app.outline_cache.path = None
+    return telegram
+
+# --- UPDATE'LAR ---
+_update_id = 0
+
+def _next_update_id():
+    global _update_id
+    _update_id += 1
+    return _update_id
+
+def _user(uid):
+    return {'id': uid, 'is_bot': False, 'first_name': 'Bench', 'username': 'bench', 'language_code': 'uz'}
+
+def text_update(text, uid=BENCH_UID):
+    return types.Update(**{'update_id': _next_update_id(), 'message': {
+        'message_id': _next_update_id(), 'date': int(time.time()), 'text': text,
+        'chat': {'id': uid, 'type': 'private'}, 'from': _user(uid)}})
+
+def callback_update(data, uid=BENCH_UID):
+    return types.Update(**{'update_id': _next_update_id(), 'callback_query': {
+        'id': str(_next_update_id()), 'chat_instance': '1', 'data': data, 'from': _user(uid),
+        'message': {'message_id': 1, 'date': int(time.time()), 'text': '-',
+                    'chat': {'id': uid, 'type': 'private'}, 'from': _user(123456)}}})
+
+# --- BOSQICHLAR ---
+# Har bir bosqich: nom -> (fabrika, asinxronmi). Fabrika bitta operatsiyani bajaradigan
+# funksiyani qaytaradi; tayyorlov ishi o'lchovdan tashqarida qoladi.
+STAGES = {}
+
+def stage(name, is_async=False):
+    def register(factory):
+        STAGES[name] = (factory, is_async)
+        return factory
+    return register
+
+@stage('xml_escape/long')
+def _():
+    return lambda: app.xml_escape(LONG_POINT)
+
+@stage('clean_json_string/10')
+def _():
+    text = outline_response("Quyosh tizimi", 10)
+    return lambda: app.clean_json_string(text)
+
+@stage('parse_outline/15')
+def _():
+    text = outline_response("Quyosh tizimi", 15)
+    return lambda: app.parse_outline(text)
+
+@stage('stream_parser/15')
+def _():
+    text   = outline_response("Quyosh tizimi", 15)
+    chunks = [text[i:i + 24] for i in range(0, len(text), 24)]
+
+    def run():
+        parser = app.SlideStreamParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+    return run
+
+@stage('render_slide_xml/long')
+def _():
+    slide = make_outline("Quyosh tizimi", 1, long_text=True)['slides'][0]
+    return lambda: app.render_slide_xml(0, slide)
+
+for _n in (7, 10, 15, 50):
+    @stage(f'pptx/{_n}')
+    def _(n=_n):
+        data = make_outline("Quyosh tizimi", n)
+        return lambda: app.create_presentation_file("Quyosh tizimi", data, BENCH_UID)
+
+@stage('pptx/15-long')
+def _():
+    data = make_outline("Quyosh tizimi", 15, long_text=True)
+    return lambda: app.create_presentation_file("Quyosh tizimi", data, BENCH_UID)
+
+@stage('handler/menu', is_async=True)
+def _():
+    text = app.LANGS['uz']['btns'][3]
+    return lambda: app.dp.process_update(text_update(text))
+
+@stage('handler/profile', is_async=True)
+def _():
+    text = app.LANGS['uz']['btns'][1]
+    return lambda: app.dp.process_update(text_update(text))
+
+@stage('handler/topic', is_async=True)
+def _():
+    return lambda: app.dp.process_update(text_update("Quyosh tizimi"))
+
+@stage('handler/gen_callback', is_async=True)
+def _():
+    # gen: tugmasi: marshrut, FSM o'qish, debit va navbatga qo'shish. Scheduler benchmarkda
+    # ishga tushirilmaydi — ish navbatdan olib tashlanadi, keyingi iteratsiya band bo'lmasin
+    async def run():
+        await app.dp.storage.update_data(chat=BENCH_UID, user=BENCH_UID, topic="Quyosh tizimi")
+        await app.dp.process_update(callback_update('gen:7'))
+        app.gen_scheduler.pending.clear()
+        app.gen_scheduler.release(BENCH_UID)
+    return run
+
+def generation(num_slides):
+    async def run():
+        message = types.Message(**{'message_id': 1, 'date': int(time.time()), 'text': '-',
+                                   'chat': {'id': BENCH_UID, 'type': 'private'}})
+        job = app.GenJob(BENCH_UID, 'uz', False, f"Mavzu {_next_update_id()}", num_slides, num_slides, message)
+        await job.run()
+    return run
+
+@stage('generation/7', is_async=True)
+def _():
+    # Navbat, Groq oqimi (stub), slayd XML, render (jarayonlar puli) va yuborish
+    return generation(7)
+
+@stage('generation/30', is_async=True)
+def _():
+    # Ikki bosqichli rejim: sarlavhalar + parallel guruhlar
+    return generation(30)
+
+# --- O'LCHASH ---
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+async def measure(name, iterations, warmup):
+    factory, is_async = STAGES[name]
+    op = factory()
+
+    async def call():
+        if is_async:
+            await op()
+        else:
+            op()
+
+    for _ in range(warmup):
+        await call()
+
+    gc.collect()
+    timings = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        await call()
+        timings.append(time.perf_counter() - t0)
+    total = time.perf_counter() - started
+
+    # Xotira alohida o'tishda: tracemalloc vaqt o'lchovini buzmasligi uchun
+    gc.collect()
+    tracemalloc.start()
+    for _ in range(max(1, min(iterations, 20))):
+        await call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    return {
+        'iterations': iterations,
+        'ops_per_sec': iterations / total if total else 0.0,
+        'p50_ms':      percentile(timings, 0.50) * 1000,
+        'p99_ms':      percentile(timings, 0.99) * 1000,
+        'peak_kb':     peak / 1024,
+    }
+
+def print_table(results, baseline=None):
+    head = f"{'bosqich':<24}{'ops/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'peak KB':>10}"
+    if baseline:
+        head += f"{'Δp50':>9}{'Δp99':>9}"
+    print(head)
+    print("-" * len(head))
+    for name, r in results.items():
+        line = (f"{name:<24}{r['ops_per_sec']:>12.1f}{r['p50_ms']:>10.3f}"
+                f"{r['p99_ms']:>10.3f}{r['peak_kb']:>10.1f}")
+        base = (baseline or {}).get(name)
+        if base:
+            line += f"{_delta(r['p50_ms'], base['p50_ms']):>9}{_delta(r['p99_ms'], base['p99_ms']):>9}"
+        print(line)
+
+def _delta(new, old):
+    return f"{(new - old) / old:+.0%}" if old else "—"
+
+def regressions(results, baseline, threshold):
+    found = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for field in ('p50_ms', 'p99_ms', 'peak_kb'):
+            if base[field] and r[field] > base[field] * (1 + threshold):
+                found.append(f"{name}: {field} {base[field]:.3f} → {r[field]:.3f}")
+    return found
+
+async def main(args):
+    telegram = install_fakes()
+    # Ishlatiladigan foydalanuvchi va bot identifikatori oldindan tayyorlanadi
+    await app.db.add_user(BENCH_UID, 'bench', 'Bench', None)
+    Bot.set_current(app.bot)
+    Dispatcher.set_current(app.dp)
+    await app.bot.me
+    app.render_pool.start()
+
+    names = [n for n in STAGES if not args.filter or any(k in n for k in args.filter)]
+    results = {}
+    try:
+        for name in names:
+            iterations = args.iterations
+            if name.startswith('generation/'):
+                iterations = max(5, iterations // 10)
+            results[name] = await measure(name, iterations, args.warmup)
+    finally:
+        app.render_pool.shutdown()
+        session = await app.bot.get_session()
+        await session.close()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    print_table(results, baseline)
+    print(f"\nTelegram so'rovlari (soxta): {telegram.calls}")
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'created_at': datetime.now().isoformat(timespec='seconds'),
+                       'results': results}, f, indent=2)
+        print(f"💾 Natijalar saqlandi: {args.save}")
+
+    if baseline is not None:
+        found = regressions(results, baseline, args.threshold)
+        if found:
+            print(f"\n❌ Regressiya (>{args.threshold:.0%}):")
+            for line in found:
+                print(f"  • {line}")
+            return 1
+        print(f"\n✅ Regressiya yo'q (chegara {args.threshold:.0%})")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Slide Master AI Bot — oflayn benchmark")
+    parser.add_argument('-n', '--iterations', type=int, default=100)
+    parser.add_argument('-w', '--warmup', type=int, default=5)
+    parser.add_argument('-k', '--filter', action='append', help="bosqich nomidagi qism (bir necha marta)")
+    parser.add_argument('--save', help="natijalarni JSON faylga yozish")
+    parser.add_argument('--compare', help="bazaviy JSON bilan solishtirish")
+    parser.add_argument('--threshold', type=float, default=0.15)
+    sys.exit(asyncio.run(main(parser.parse_args())))
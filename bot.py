@@ -1,24 +1,45 @@
+import time
+_BOOT_T0 = time.perf_counter()   # import bosqichini ishga tushish logida ko'rsatish uchun
 import logging
 import asyncio
+import bisect
+import functools
+import io
 import os
 import re
 import json
+import copy
+import csv
 import sys
-import time
+import random
+import hashlib
+import hmac
+import itertools
+import sqlite3
+import threading
+import unicodedata
 import zipfile
-import psycopg2
-import psycopg2.extras
+import asyncpg
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from aiohttp import web
-from groq import AsyncGroq
 from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.storage import BaseStorage
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.handler import CancelHandler
 from aiogram.types import (ReplyKeyboardMarkup, KeyboardButton,
                            InlineKeyboardMarkup, InlineKeyboardButton,
                            InputFile, CallbackQuery)
-from aiogram.utils.executor import start_webhook
-from datetime import datetime
+from aiogram.utils.exceptions import (TelegramAPIError, RetryAfter, Unauthorized,
+                                      ChatNotFound, MessageNotModified, BadRequest)
+from datetime import datetime, timedelta
+from types import MappingProxyType
+_BOOT_IMPORTED = time.perf_counter()
 
 # --- 1. KONFIGURATSIYA VA LOGGING ---
 logging.basicConfig(
@@ -37,6 +58,108 @@ WEBHOOK_HOST = os.getenv('RENDER_EXTERNAL_URL')
 PORT         = int(os.getenv("PORT", 10000))
 CHANNEL_ID   = "@abdujalils"
 WEBHOOK_PATH = f"/webhook"
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")   # lokal Bot API server yoki yuklama testi mock'i
+
+# Webhook: update darhol navbatga qo'yiladi va 200 qaytariladi
+UPDATE_WORKERS       = int(os.getenv("UPDATE_WORKERS", 16))
+UPDATE_QUEUE_MAX     = int(os.getenv("UPDATE_QUEUE_MAX", 2000))
+UPDATE_SHED_POLICY   = os.getenv("UPDATE_SHED_POLICY", "drop")   # drop | retry (503 → Telegram qayta yuboradi)
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("UPDATE_DRAIN_TIMEOUT", 10))
+
+# PostgreSQL ulanishlar puli
+DB_POOL_MIN        = int(os.getenv("DB_POOL_MIN", 2))
+DB_POOL_MAX        = int(os.getenv("DB_POOL_MAX", 10))
+DB_SSL             = os.getenv("DB_SSL", "require")   # 'disable' — lokal baza uchun
+DB_QUERY_TIMEOUT   = float(os.getenv("DB_QUERY_TIMEOUT", 10))
+DB_IDLE_LIFETIME   = float(os.getenv("DB_IDLE_LIFETIME", 300))
+DB_STMT_CACHE_SIZE = int(os.getenv("DB_STMT_CACHE_SIZE", 100))
+
+# Foydalanuvchi profillari keshi
+USER_CACHE_SIZE    = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL     = float(os.getenv("USER_CACHE_TTL", 300))
+ACTIVITY_FLUSH_EVERY = float(os.getenv("ACTIVITY_FLUSH_EVERY", 5))
+
+# FSM holatlari (PostgreSQL + xotiradagi LRU)
+FSM_TTL            = float(os.getenv("FSM_TTL", 24 * 3600))   # shundan eski holatlar o'chiriladi
+FSM_CACHE_SIZE     = int(os.getenv("FSM_CACHE_SIZE", 20000))
+FSM_CACHE_TTL      = float(os.getenv("FSM_CACHE_TTL", 0))   # 0 — keshsiz; >0 faqat bitta instance bo'lsa
+FSM_CLEANUP_EVERY  = float(os.getenv("FSM_CLEANUP_EVERY", 600))
+FSM_CLEANUP_BATCH  = int(os.getenv("FSM_CLEANUP_BATCH", 1000))
+
+# Kanal a'zoligi keshi (obuna bo'lganlar uzoqroq, bo'lmaganlar qisqa saqlanadi)
+SUB_CACHE_SIZE     = int(os.getenv("SUB_CACHE_SIZE", 50000))
+SUB_CACHE_POS_TTL  = float(os.getenv("SUB_CACHE_POS_TTL", 600))
+SUB_CACHE_NEG_TTL  = float(os.getenv("SUB_CACHE_NEG_TTL", 20))
+
+# Broadcast (Telegram limiti: ~30 xabar/soniya barcha chatlarga)
+BROADCAST_RATE        = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+BROADCAST_PAGE_SIZE   = int(os.getenv("BROADCAST_PAGE_SIZE", 200))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 3))
+BROADCAST_REPORT_EVERY = float(os.getenv("BROADCAST_REPORT_EVERY", 5))
+
+# Throttling: amal turi bo'yicha "foydalanuvchi_tezligi/sig'imi,global_tezlik/sig'imi"
+# (tokenlar soniyasiga; 0 — cheklovsiz). Admin cheklanmaydi.
+THROTTLE_ENABLED   = os.getenv("THROTTLE_ENABLED", "1") == "1"
+THROTTLE_MESSAGE   = os.getenv("THROTTLE_MESSAGE", "1/5,200/400")      # matn va tugmalar
+THROTTLE_GENERATE  = os.getenv("THROTTLE_GENERATE", "0.05/3,5/20")     # gen: (Groq so'rovi)
+THROTTLE_PAYMENT   = os.getenv("THROTTLE_PAYMENT", "0.1/3,10/30")      # chek yuklash
+THROTTLE_START     = os.getenv("THROTTLE_START", "0.2/3,20/100")       # /start (referal havolalar)
+THROTTLE_IDLE      = float(os.getenv("THROTTLE_IDLE", 600))            # bo'sh bucket'lar o'chiriladi
+THROTTLE_NOTICE_EVERY = float(os.getenv("THROTTLE_NOTICE_EVERY", 10))  # ogohlantirish oralig'i
+
+# PPTX render jarayonlar puli (CPU ishi event loop'dan tashqarida)
+RENDER_WORKERS     = int(os.getenv("RENDER_WORKERS", 2))
+RENDER_QUEUE_MAX   = int(os.getenv("RENDER_QUEUE_MAX", 16))
+RENDER_TIMEOUT     = float(os.getenv("RENDER_TIMEOUT", 30))
+
+# AI model va slayd rejasi (outline) keshi
+GROQ_MODEL         = os.getenv("GROQ_MODEL", "llama3-8b-8192")
+PROMPT_VERSION     = "1"   # prompt o'zgarsa oshiring — eski kesh yozuvlari ishlatilmaydi
+OUTLINE_CACHE_SIZE = int(os.getenv("OUTLINE_CACHE_SIZE", 2000))
+OUTLINE_CACHE_TTL  = float(os.getenv("OUTLINE_CACHE_TTL", 7 * 24 * 3600))
+OUTLINE_CACHE_PATH = os.getenv("OUTLINE_CACHE_PATH")   # masalan: outlines.sqlite3 (ixtiyoriy)
+OUTLINE_PRUNE_EVERY = int(os.getenv("OUTLINE_PRUNE_EVERY", 100))   # har N ta yozuvdan keyin faylni tozalash
+OUTLINE_VARIANTS   = int(os.getenv("OUTLINE_VARIANTS", 3))
+OUTLINE_VARIETY    = float(os.getenv("OUTLINE_VARIETY", 0))   # keshda bo'lsa ham yangi variant yaratish ehtimoli
+GROQ_STREAM        = os.getenv("GROQ_STREAM", "1") == "1"     # javobni oqim bilan olish va jarayonni ko'rsatish
+PROGRESS_EDIT_EVERY = float(os.getenv("PROGRESS_EDIT_EVERY", 2))
+
+# Katta taqdimotlar ikki bosqichda: avval sarlavhalar, so'ng slayd guruhlari parallel to'ldiriladi
+EXPAND_MIN_SLIDES  = int(os.getenv("EXPAND_MIN_SLIDES", 15))   # shuncha va undan ko'p slaydda
+EXPAND_GROUP       = int(os.getenv("EXPAND_GROUP", 5))          # bitta so'rovdagi slaydlar soni
+
+# Groq chaqiruvlari: vaqt chegaralari, qayta urinish, circuit breaker va zaxira modellar
+GROQ_FALLBACK_MODELS  = [m.strip() for m in os.getenv("GROQ_FALLBACK_MODELS", "llama-3.1-8b-instant").split(",")
+                         if m.strip()]
+GROQ_ATTEMPT_TIMEOUT  = float(os.getenv("GROQ_ATTEMPT_TIMEOUT", 45))   # bitta urinish (oqim bilan birga)
+GROQ_TOTAL_TIMEOUT    = float(os.getenv("GROQ_TOTAL_TIMEOUT", 90))     # barcha urinishlar va kutishlar
+GROQ_RETRIES          = int(os.getenv("GROQ_RETRIES", 2))              # har bir model uchun qayta urinishlar
+GROQ_BACKOFF_BASE     = float(os.getenv("GROQ_BACKOFF_BASE", 0.5))
+GROQ_BACKOFF_MAX      = float(os.getenv("GROQ_BACKOFF_MAX", 8))        # Retry-After bundan uzoq — keyingi model
+GROQ_HEDGE_AFTER      = float(os.getenv("GROQ_HEDGE_AFTER", 0))        # javob bo'lmasa ikkinchi so'rov (0 — yo'q)
+GROQ_BREAKER_FAILURES = int(os.getenv("GROQ_BREAKER_FAILURES", 5))
+GROQ_BREAKER_RESET    = float(os.getenv("GROQ_BREAKER_RESET", 30))
+
+# Generatsiya navbati
+GEN_CONCURRENCY    = int(os.getenv("GEN_CONCURRENCY", 4))
+GROQ_CONCURRENCY   = int(os.getenv("GROQ_CONCURRENCY", GEN_CONCURRENCY))   # bir vaqtda Groq so'rovlari (jami)
+GEN_QUEUE_MAX      = int(os.getenv("GEN_QUEUE_MAX", 100))
+GEN_POSITION_EVERY = float(os.getenv("GEN_POSITION_EVERY", 3))
+GEN_POSITION_EDITS = int(os.getenv("GEN_POSITION_EDITS", 20))   # bitta yangilashda ko'pi bilan
+
+# Bir nechta mavzu ("1." / "-" bilan boshlanadigan ro'yxat) — bitta ZIP arxiv
+BATCH_MAX_TOPICS   = int(os.getenv("BATCH_MAX_TOPICS", 30))
+BATCH_CONCURRENCY  = int(os.getenv("BATCH_CONCURRENCY", 3))    # bitta paketda bir vaqtda ishlanadigan mavzular
+
+# Tayyor taqdimotlar keshi: bir xil fayl Telegram'ga qayta yuklanmaydi, file_id bilan yuboriladi
+RENDER_VERSION     = "1"   # PPTX shabloni o'zgarsa oshiring — eski file_id'lar ishlatilmaydi
+DECK_CACHE_MAX     = int(os.getenv("DECK_CACHE_MAX", 20000))   # ko'pi bilan saqlanadigan file_id
+DECK_PRUNE_EVERY   = int(os.getenv("DECK_PRUNE_EVERY", 100))   # har N ta yangi yozuvdan keyin tozalash
+
+# Admin statistikasi (kunlik hisoblagichlar)
+STATS_DAYS         = int(os.getenv("STATS_DAYS", 7))       # panelda ko'rsatiladigan kunlar
+STATS_EXPORT_DAYS  = int(os.getenv("STATS_EXPORT_DAYS", 365))
 
 # postgres:// → postgresql://
 if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
@@ -57,12 +180,28 @@ except ValueError:
     ADMIN_ID = 0
 
 WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}" if WEBHOOK_HOST else None
-
-# Global obyektlar
-client  = AsyncGroq(api_key=GROQ_API_KEY)
-storage = MemoryStorage()
-bot     = Bot(token=API_TOKEN, parse_mode="Markdown")
-dp      = Dispatcher(bot, storage=storage)
+# Telegram har bir so'rovda X-Telegram-Bot-Api-Secret-Token sarlavhasida yuboradi.
+# Berilmasa tokendan hosil qilinadi — barcha instance'larda bir xil bo'ladi.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(API_TOKEN.encode()).hexdigest()
+# /metrics faqat shu token bilan: "Authorization: Bearer <token>" yoki ?token=<token>.
+# Berilmasa endpoint o'chiq (404) — webhook host'i ommaviy.
+METRICS_TOKEN  = os.getenv("METRICS_TOKEN")
+
+# Global obyektlar: bot — METRIKALAR, storage va dp — DATABASE bo'limidan keyin.
+# Groq klienti birinchi kerak bo'lganda yaratiladi: groq paketi importi (httpx,
+# pydantic modellari) sovuq startning sezilarli qismini oladi.
+_groq      = None
+_groq_lock = threading.Lock()
+
+def groq_client():
+    global _groq
+    if _groq is None:
+        with _groq_lock:
+            if _groq is None:
+                from groq import AsyncGroq
+                # Qayta urinishlar va timeout'lar GroqCaller'da — SDK o'zi takrorlamaydi
+                _groq = AsyncGroq(api_key=GROQ_API_KEY, max_retries=0, timeout=GROQ_ATTEMPT_TIMEOUT)
+    return _groq
 
 # --- 2. HOLATLAR ---
 class UserStates(StatesGroup):
@@ -80,20 +219,31 @@ LANGS = {
         'sub_err':            "🔒 **Botdan foydalanish cheklangan!**\n\nDavom etish uchun rasmiy kanalimizga obuna bo'ling:",
         'tarif':              "💎 **TAQDIMOT NARXLARI:**\n\n⚡ **1 ta Slayd:** 990 so'm\n🔥 **5 ta Slayd:** 2,999 so'm\n👑 **VIP Premium (Cheksiz):** 5,999 so'm\n\n💳 **To'lov kartasi:** `9860230107924485`\n👤 **Karta egasi:** Abdujalil A.\n\n📸 *To'lov chekini shu yerga yuboring va paketni tanlang:*",
         'wait':               "🧠 **AI ishlamoqda...**\n\nSlayd tuzilishi generatsiya qilinmoqda. 30-60 soniya vaqt oladi.",
+        'progress':           "🧠 **AI ishlamoqda...**\n\n📄 Slayd {n} / {total} tayyor",
         'done':               "✅ **Taqdimot tayyor!**\n\nFaylni ochish uchun PowerPoint yoki WPS Office ishlating.",
+        'dropped':            "\n\n⚠️ Rejadagi {slides}-slaydlar tayyorlanmadi va taqdimotga kiritilmadi — ular balansga qaytarildi.",
         'no_bal':             "⚠️ **Balans yetarli emas!**\n\nHisobni to'ldiring yoki do'stlaringizni taklif qiling.",
         'cancel':             "❌ Bekor qilish",
         'ref_text':           "🚀 **DO'STLARINGIZNI TAKLIF QILING**\n\n",
         'lang_name':          "🇺🇿 O'zbekcha",
         'gen_prompt':         "Mavzu: {topic}. Nechta slayd kerak?",
+        'batch_prompt':       "📚 **{count} ta mavzu.** Har bir taqdimot nechta slayd bo'lsin?\n\n💰 Jami: {count} × slaydlar soni",
+        'batch_progress':     "📦 **Taqdimotlar tayyorlanmoqda...**\n\n✅ {done} / {total} tayyor",
+        'batch_done':         "✅ **{done} / {total} ta taqdimot tayyor!**\n\nArxivni oching, fayllarni PowerPoint yoki WPS Office'da ishlating.",
+        'batch_failed':       "\n\n⚠️ {failed} ta mavzu tayyorlanmadi — slaydlari balansga qaytarildi.",
         'btn_check':          "✅ Obunani tekshirish",
         'btn_join':           "📢 Kanalga qo'shilish",
         'error':              "⚠️ Xatolik yuz berdi. Iltimos qayta urinib ko'ring.",
+        'busy':               "⏳ Bot hozir band. Iltimos bir ozdan so'ng qayta urinib ko'ring.",
+        'throttled':          "🐢 Juda tez! Iltimos bir necha soniya kutib, qayta urinib ko'ring.",
+        'queued':             "⏳ **Navbatdasiz: {pos}-o'rin**\n\nNavbatingiz kelganda taqdimot avtomatik tayyorlanadi.",
+        'already_running':    "⏳ Oldingi taqdimotingiz hali tayyorlanmoqda. Iltimos kuting.",
         'payment_sent':       "✅ Chek adminga yuborildi. Tez orada javob beriladi.\n\n📋 *To'lov tasdiqlangandan so'ng paket aktivlashtiriladi.*",
         'admin_panel':        "🛠 **Admin panel**\n\nTanlang:",
         'broadcast_start':    "📢 Reklama xabarini yuboring (text/photo/video):",
         'broadcast_canceled': "❌ Bekor qilindi.",
         'broadcast_sent':     "✅ Xabar {count} ta foydalanuvchiga yuborildi.",
+        'broadcast_progress': "📢 **Broadcast #{id}**\n\n✅ Yuborildi: {sent}/{total}\n⚠️ Xato: {failed}",
         'help_text':          "📚 **QO'LLANMA**\n\n1️⃣ Kanalga obuna bo'ling\n2️⃣ Mavzu yozing va slayd sonini tanlang\n3️⃣ AI prezentatsiya yaratadi\n4️⃣ PowerPoint yoki WPS Office'da oching\n\n🤝 Har bir do'stingiz uchun +1 slayd bonus!",
         'package_btns':       ["1️⃣ 1 ta Slayd", "5️⃣ 5 ta Slayd", "👑 VIP Premium"],
         'balance_added':      "💰 **Balans to'ldirildi!**\n\nHisobingizga **{amount} ta slayd** qo'shildi!",
@@ -105,20 +255,31 @@ LANGS = {
         'sub_err':            "🔒 **Доступ ограничен!**\n\nПодпишитесь на наш канал для продолжения:",
         'tarif':              "💎 **ТАРИФЫ:**\n\n⚡ **1 Слайд:** 990 сум\n🔥 **5 Слайдов:** 2,999 сум\n👑 **VIP Premium (Безлимит):** 5,999 сум\n\n💳 **Карта:** `9860230107924485`\n👤 **Владелец:** Abdujalil A.\n\n📸 *Отправьте скриншот чека и выберите пакет:*",
         'wait':               "🧠 **AI работает...**\n\nГенерируем структуру. 30-60 секунд.",
+        'progress':           "🧠 **AI работает...**\n\n📄 Слайд {n} из {total} готов",
         'done':               "✅ **Презентация готова!**\n\nИспользуйте PowerPoint или WPS Office.",
+        'dropped':            "\n\n⚠️ Слайды {slides} из плана не удалось подготовить, они не вошли в презентацию — слайды возвращены на баланс.",
         'no_bal':             "⚠️ **Недостаточно баланса!**\n\nПополните счет или пригласите друзей.",
         'cancel':             "❌ Отмена",
         'ref_text':           "🚀 **ПРИГЛАСИТЕ ДРУЗЕЙ**\n\n",
         'lang_name':          "🇷🇺 Русский",
         'gen_prompt':         "Тема: {topic}. Сколько слайдов нужно?",
+        'batch_prompt':       "📚 **Тем: {count}.** Сколько слайдов в каждой презентации?\n\n💰 Итого: {count} × число слайдов",
+        'batch_progress':     "📦 **Готовим презентации...**\n\n✅ Готово {done} из {total}",
+        'batch_done':         "✅ **Готово презентаций: {done} из {total}!**\n\nОткройте архив и используйте PowerPoint или WPS Office.",
+        'batch_failed':       "\n\n⚠️ Не удалось подготовить тем: {failed} — слайды возвращены на баланс.",
         'btn_check':          "✅ Проверить подписку",
         'btn_join':           "📢 Подписаться",
         'error':              "⚠️ Произошла ошибка. Попробуйте снова.",
+        'busy':               "⏳ Бот сейчас перегружен. Попробуйте чуть позже.",
+        'throttled':          "🐢 Слишком часто! Подождите несколько секунд и попробуйте снова.",
+        'queued':             "⏳ **Вы в очереди: {pos}-е место**\n\nПрезентация начнёт создаваться автоматически.",
+        'already_running':    "⏳ Ваша предыдущая презентация ещё создаётся. Пожалуйста, подождите.",
         'payment_sent':       "✅ Чек отправлен администратору.\n\n📋 *После подтверждения пакет будет активирован.*",
         'admin_panel':        "🛠 **Админ панель**\n\nВыберите:",
         'broadcast_start':    "📢 Отправьте рекламное сообщение (text/photo/video):",
         'broadcast_canceled': "❌ Отменено.",
         'broadcast_sent':     "✅ Сообщение отправлено {count} пользователям.",
+        'broadcast_progress': "📢 **Рассылка #{id}**\n\n✅ Отправлено: {sent}/{total}\n⚠️ Ошибок: {failed}",
         'help_text':          "📚 **ИНСТРУКЦИЯ**\n\n1️⃣ Подпишитесь на канал\n2️⃣ Напишите тему и выберите количество слайдов\n3️⃣ AI создаст презентацию\n4️⃣ Откройте в PowerPoint или WPS Office\n\n🤝 +1 слайд за каждого приглашенного!",
         'package_btns':       ["1️⃣ 1 Слайд", "5️⃣ 5 Слайдов", "👑 VIP Premium"],
         'balance_added':      "💰 **Баланс пополнен!**\n\nДобавлено **{amount} слайдов**!",
@@ -130,20 +291,31 @@ LANGS = {
         'sub_err':            "🔒 **Access Restricted!**\n\nPlease subscribe to our channel to continue:",
         'tarif':              "💎 **PRICING:**\n\n⚡ **1 Slide:** 990 UZS\n🔥 **5 Slides:** 2,999 UZS\n👑 **VIP Premium (Unlimited):** 5,999 UZS\n\n💳 **Card:** `9860230107924485`\n👤 **Owner:** Abdujalil A.\n\n📸 *Send receipt screenshot here and choose package:*",
         'wait':               "🧠 **AI is thinking...**\n\nGenerating structure and design. 30-60 seconds.",
+        'progress':           "🧠 **AI is thinking...**\n\n📄 Slide {n} of {total} ready",
         'done':               "✅ **Presentation ready!**\n\nOpen with PowerPoint or WPS Office.",
+        'dropped':            "\n\n⚠️ Planned slides {slides} could not be generated and were left out — they were returned to your balance.",
         'no_bal':             "⚠️ **Insufficient balance!**\n\nTop up or invite friends for free slides.",
         'cancel':             "❌ Cancel",
         'ref_text':           "🚀 **INVITE YOUR FRIENDS**\n\n",
         'lang_name':          "🇬🇧 English",
         'gen_prompt':         "Topic: {topic}. How many slides needed?",
+        'batch_prompt':       "📚 **{count} topics.** How many slides per presentation?\n\n💰 Total: {count} × slides",
+        'batch_progress':     "📦 **Preparing presentations...**\n\n✅ {done} of {total} ready",
+        'batch_done':         "✅ **{done} of {total} presentations ready!**\n\nOpen the archive and use PowerPoint or WPS Office.",
+        'batch_failed':       "\n\n⚠️ {failed} topics failed — their slides were returned to your balance.",
         'btn_check':          "✅ Check Subscription",
         'btn_join':           "📢 Join Channel",
         'error':              "⚠️ An error occurred. Please try again.",
+        'busy':               "⏳ The bot is busy right now. Please try again shortly.",
+        'throttled':          "🐢 Too fast! Please wait a few seconds and try again.",
+        'queued':             "⏳ **You are #{pos} in the queue**\n\nYour presentation will start automatically.",
+        'already_running':    "⏳ Your previous presentation is still being generated. Please wait.",
         'payment_sent':       "✅ Receipt sent to admin.\n\n📋 *Package will be activated after payment confirmation.*",
         'admin_panel':        "🛠 **Admin Panel**\n\nSelect:",
         'broadcast_start':    "📢 Send broadcast message (text/photo/video):",
         'broadcast_canceled': "❌ Canceled.",
         'broadcast_sent':     "✅ Message sent to {count} users.",
+        'broadcast_progress': "📢 **Broadcast #{id}**\n\n✅ Sent: {sent}/{total}\n⚠️ Failed: {failed}",
         'help_text':          "📚 **GUIDE**\n\n1️⃣ Subscribe to channel\n2️⃣ Write topic and select slide count\n3️⃣ AI creates presentation\n4️⃣ Open in PowerPoint or WPS Office\n\n🤝 +1 slide bonus per invited friend!",
         'package_btns':       ["1️⃣ 1 Slide", "5️⃣ 5 Slides", "👑 VIP Premium"],
         'balance_added':      "💰 **Balance topped up!**\n\n**{amount} slides** added to your account!",
@@ -151,174 +323,1370 @@ LANGS = {
     }
 }
 
-# --- 4. DATABASE (psycopg2) ---
+# --- 3.1 KESH ---
+# Hajmi cheklangan LRU kesh, har bir yozuv TTL bilan eskiradi
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl     = ttl
+        self.hits    = 0
+        self.misses  = 0
+        self._data   = OrderedDict()   # key -> (expires_at, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.peek(key) is not None
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is not None and item[0] < time.monotonic():
+            del self._data[key]
+            item = None
+        if item is None:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def peek(self, key, default=None):
+        # Statistika va LRU tartibiga ta'sir qilmaydi
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            return default
+        return item[1]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0}
+
+# --- 3.2 RATE LIMIT ---
+# Token bucket: soniyasiga `rate` ta token, eng ko'pi bilan `capacity` ta to'planadi
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate     = rate
+        self.capacity = capacity or rate
+        self.tokens   = self.capacity
+        self.updated  = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens  = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, n=1):
+        self._refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def give_back(self, n=1):
+        self.tokens = min(self.capacity, self.tokens + n)
+
+    async def acquire(self, n=1):
+        while not self.try_acquire(n):
+            await asyncio.sleep((n - self.tokens) / self.rate)
+
+    def penalize(self, seconds):
+        # RetryAfter: keyingi `seconds` davomida token berilmaydi
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+# Kalit (foydalanuvchi) bo'yicha bucket'lar: dict orqali O(1). Uzoq ishlatilmagan bucket
+# baribir to'lib qolgan bo'ladi, shuning uchun davriy tozalashda xavfsiz o'chiriladi.
+class KeyedBuckets:
+    def __init__(self, rate, capacity=None, idle=600):
+        self.rate     = rate
+        self.capacity = capacity or rate
+        self.idle     = max(idle, self.capacity / rate)
+        self.buckets  = {}
+        self._swept   = time.monotonic()
+
+    def try_acquire(self, key, n=1):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self._maybe_sweep()
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.capacity)
+        return bucket.try_acquire(n)
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        if now - self._swept < self.idle:
+            return
+        self._swept = now
+        cutoff = now - self.idle
+        for key in [k for k, b in self.buckets.items() if b.updated < cutoff]:
+            del self.buckets[key]
+
+    def __len__(self):
+        return len(self.buckets)
+
+# Har bir amal turi uchun: foydalanuvchi bucket'lari + bitta global bucket
+class Throttle:
+    def __init__(self, specs, idle):
+        self.limits = {}
+        for action, spec in specs.items():
+            (user_rate, user_cap), (total_rate, total_cap) = (
+                map(float, part.split('/')) for part in spec.split(','))
+            self.limits[action] = (
+                KeyedBuckets(user_rate, user_cap, idle) if user_rate > 0 else None,
+                TokenBucket(total_rate, total_cap) if total_rate > 0 else None)
+
+    # None — ruxsat; aks holda qaysi chegara oshgani: 'user' yoki 'global'
+    def check(self, action, uid):
+        users, total = self.limits[action]
+        # Avval global: u rad etgan update foydalanuvchi kvotasini sarflamaydi
+        if total is not None and not total.try_acquire():
+            return 'global'
+        if users is not None and not users.try_acquire(uid):
+            if total is not None:
+                total.give_back()
+            return 'user'
+        return None
+
+    def size(self):
+        return sum(len(users) for users, _ in self.limits.values() if users is not None)
+
+# --- 3.3 TUGMALAR VA KLAVIATURALAR ---
+# LANGS bir marta kompilyatsiya qilinadi: tugma matni -> amal (barcha tillar bo'yicha),
+# klaviaturalar esa har bir til uchun oldindan quriladi va qayta ishlatiladi.
+MENU_ACTIONS = ('tariffs', 'profile', 'invite', 'guide', 'language')
+PACKAGES     = (("1_slide", 990), ("5_slides", 2999), ("vip_premium", 5999))
+SHARE_BTN    = "📤 Ulashish"
+GEN_OPTIONS  = (7, 10, 15, 20, 30)
+BATCH_OPTIONS = (7, 10, 15)
+
+def _compile_routes():
+    routes, packages = {}, {}
+
+    def add(table, text, value):
+        if table.get(text, value) != value:
+            raise ValueError(f"Tugma matni ikki xil amalga tegishli: {text!r}")
+        table[text] = value
+
+    for t in LANGS.values():
+        for action, label in zip(MENU_ACTIONS, t['btns']):
+            add(routes, label, action)
+        add(routes, t['cancel'], 'cancel')
+        for label, package in zip(t['package_btns'], PACKAGES):
+            add(packages, label, package)
+    add(routes, SHARE_BTN, 'share')
+    return MappingProxyType(routes), MappingProxyType(packages)
+
+BUTTON_ROUTES, PACKAGE_BY_TEXT = _compile_routes()
+
+def _reply_kb(*rows):
+    kb = ReplyKeyboardMarkup(resize_keyboard=True)
+    for row in rows:
+        kb.add(*[KeyboardButton(text) for text in row])
+    return kb
+
+MAIN_KB   = MappingProxyType({
+    code: _reply_kb(t['btns'][0:2], t['btns'][2:4], t['btns'][4:5]) for code, t in LANGS.items()})
+TARIF_KB  = MappingProxyType({
+    code: _reply_kb(t['package_btns'][0:2], t['package_btns'][2:3], [t['cancel']])
+    for code, t in LANGS.items()})
+CANCEL_KB = MappingProxyType({code: _reply_kb([t['cancel']]) for code, t in LANGS.items()})
+INVITE_KB = MappingProxyType({code: _reply_kb([SHARE_BTN], [t['cancel']]) for code, t in LANGS.items()})
+SUB_IKB   = MappingProxyType({
+    code: InlineKeyboardMarkup().add(
+        InlineKeyboardButton(t['btn_join'], url=f"https://t.me/{CHANNEL_ID[1:]}"),
+        InlineKeyboardButton(t['btn_check'], callback_data="check_sub")
+    ) for code, t in LANGS.items()})
+LANG_IKB  = InlineKeyboardMarkup()
+for _code in LANGS:
+    LANG_IKB.add(InlineKeyboardButton(LANGS[_code]['lang_name'], callback_data=f"lang_{_code}"))
+GEN_IKB   = InlineKeyboardMarkup().add(*[
+    InlineKeyboardButton(f"📄 {n} slayd", callback_data=f"gen:{n}") for n in GEN_OPTIONS])
+BATCH_IKB = InlineKeyboardMarkup().add(*[
+    InlineKeyboardButton(f"📚 {n} slayd", callback_data=f"batch:{n}") for n in BATCH_OPTIONS])
+STATS_IKB = InlineKeyboardMarkup().add(InlineKeyboardButton("📥 CSV eksport", callback_data="admin_export"))
+ADMIN_IKB = InlineKeyboardMarkup().add(
+    InlineKeyboardButton("📊 Statistika", callback_data="admin_stats"),
+    InlineKeyboardButton("📢 Broadcast",  callback_data="admin_broadcast")
+).add(InlineKeyboardButton("🧾 Ledger", callback_data="admin_ledger"))
+
+# --- 3.4 METRIKALAR (Prometheus) ---
+# O'lchash faqat lug'atdagi sonni oshirish — doimiy yoqilgan holda qoldirsa bo'ladi.
+# Matnga aylantirish faqat /metrics so'ralganda bajariladi.
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+METRICS = []
+
+def _esc(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name   = name
+        self.help   = help
+        self.labels = tuple(labels)
+        self.values = {}   # label qiymatlari (tuple) -> qiymat
+        METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(n, '') for n in self.labels)
+
+    def _fmt(self, key, extra=None):
+        pairs = [f'{n}="{_esc(v)}"' for n, v in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield f"{self.name}{self._fmt(key)} {value}"
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+# Qiymati scrape paytida fn() dan olinadi (label bo'lsa fn {label tuple: qiymat} qaytaradi)
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn, labels=()):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def samples(self):
+        try:
+            value = self.fn()
+        except Exception as e:
+            logger.warning(f"Gauge {self.name} xato: {e}")
+            return
+        self.values = value if self.labels else {(): value}
+        yield from super().samples()
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        row = self.values.get(key)
+        if row is None:
+            row = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]   # bucket'lar, sum, count
+        row[0][bisect.bisect_left(self.buckets, value)] += 1
+        row[1] += value
+        row[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            acc = 0
+            for le, n in zip((*self.buckets, '+Inf'), counts):
+                acc += n
+                bound = f'le="{le}"'
+                yield f"{self.name}_bucket{self._fmt(key, bound)} {acc}"
+            yield f"{self.name}_sum{self._fmt(key)} {total}"
+            yield f"{self.name}_count{self._fmt(key)} {count}"
+
+def timed(histogram, fn, **labels):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        with histogram.time(**labels):
+            return await fn(*args, **kwargs)
+    return wrapper
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+DB_LATENCY       = Histogram('slidebot_db_seconds', "Database metodlari davomiyligi", ('method',))
+GROQ_LATENCY     = Histogram('slidebot_groq_seconds', "Groq so'rovi davomiyligi", ('model', 'mode'))
+RENDER_LATENCY   = Histogram('slidebot_render_seconds', "PPTX render davomiyligi")
+TG_LATENCY       = Histogram('slidebot_telegram_seconds', "Telegram API so'rovlari davomiyligi", ('method',))
+GEN_LATENCY      = Histogram('slidebot_generation_seconds', "Generatsiya ishining to'liq davomiyligi", ('outcome',))
+TG_ERRORS        = Counter('slidebot_telegram_errors_total', "Telegram API xatolari", ('method', 'error'))
+GENERATIONS      = Counter('slidebot_generations_total', "Generatsiya ishlari natijasi bo'yicha", ('outcome',))
+REFUNDED_SLIDES  = Counter('slidebot_refunded_slides_total', "Qaytarilgan slaydlar")
+PAYMENTS         = Counter('slidebot_payments_total', "Yuborilgan to'lov cheklari", ('package',))
+BROADCAST_MSGS   = Counter('slidebot_broadcast_messages_total', "Broadcast xabarlari", ('result',))
+DECK_REUSE       = Counter('slidebot_deck_reuse_total', "Taqdimot file_id keshi", ('result',))
+THROTTLED        = Counter('slidebot_throttled_total', "Cheklangan update'lar", ('action', 'scope'))
+GROQ_ATTEMPTS    = Counter('slidebot_groq_attempts_total', "Groq urinishlari natija bo'yicha", ('model', 'outcome'))
+GROQ_HEDGES      = Counter('slidebot_groq_hedges_total', "Sekin javob uchun yuborilgan qo'shimcha so'rovlar", ('model',))
+Gauge('slidebot_generations_running', "Ishlayotgan generatsiyalar", lambda: gen_scheduler.running)
+Gauge('slidebot_generations_queued', "Navbatdagi generatsiyalar", lambda: len(gen_scheduler.pending))
+Gauge('slidebot_render_pending', "Render pool'dagi ishlar", lambda: render_pool.pending)
+Gauge('slidebot_update_queue_depth', "Ishlanmagan webhook update'lari", lambda: update_queue.depth)
+Gauge('slidebot_broadcasts_running', "Faol broadcast'lar", lambda: len(broadcast_tasks))
+Gauge('slidebot_throttle_buckets', "Xotiradagi foydalanuvchi bucket'lari", lambda: throttle.size())
+Gauge('slidebot_groq_inflight', "Bajarilayotgan Groq so'rovlari", lambda: groq_caller.active)
+Gauge('slidebot_groq_circuit_open', "Groq circuit breaker ochiq (1) yoki yopiq (0)",
+      lambda: {(m,): int(b.is_open) for m, b in groq_caller.breakers.items()}, labels=('model',))
+Gauge('slidebot_db_pool_connections', "DB pool ulanishlari",
+      lambda: {(k,): v for k, v in db.pool_stats().items()}, labels=('state',))
+
+class MeteredBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except TelegramAPIError as e:
+            TG_ERRORS.inc(method=method, error=type(e).__name__)
+            raise
+        finally:
+            TG_LATENCY.observe(time.perf_counter() - start, method=method)
+
+bot = MeteredBot(token=API_TOKEN, parse_mode="Markdown",
+                 server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION)
+
+# --- 3.5 GROQ: RETRY, CIRCUIT BREAKER, ZAXIRA MODELLAR ---
+class GroqUnavailable(Exception):
+    pass
+
+# Model bo'yicha: ketma-ket `threshold` ta xatodan keyin `reset_after` soniya so'rov
+# yuborilmaydi (tez rad etiladi), so'ng bitta sinov so'rovi o'tkaziladi
+class CircuitBreaker:
+    def __init__(self, name, threshold, reset_after):
+        self.name        = name
+        self.threshold   = threshold
+        self.reset_after = reset_after
+        self.failures    = 0
+        self.opened_at   = None
+        self._probe_at   = None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.reset_after:
+            return False
+        if self._probe_at is not None and now - self._probe_at < self.reset_after:
+            return False   # sinov so'rovi hali tugamagan
+        self._probe_at = now
+        return True
+
+    def success(self):
+        if self.opened_at is not None:
+            logger.info(f"🔌 Groq {self.name}: circuit yopildi")
+        self.failures, self.opened_at, self._probe_at = 0, None, None
+
+    def failure(self):
+        self.failures += 1
+        self._probe_at = None
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.error(f"🔌 Groq {self.name}: circuit ochildi ({self.failures} ta xato ketma-ket)")
+            self.opened_at = time.monotonic()
+
+# groq paketi kechiktirib import qilinadi, shuning uchun xatolar atributlari bo'yicha ajratiladi.
+# None — Groq xatosi emas (masalan, JSON tahlili), qayta urinilmaydi.
+def groq_error_kind(e):
+    if isinstance(e, asyncio.TimeoutError):
+        return 'timeout'
+    status = getattr(e, 'status_code', None)
+    if status == 429:
+        return 'rate_limited'
+    if status is not None:
+        return 'server' if status >= 500 else 'client'
+    if type(e).__name__ in ('APIConnectionError', 'APITimeoutError'):
+        return 'connection'
+    return None
+
+def groq_error_text(e):
+    if e is None:
+        return "circuit ochiq"
+    if isinstance(e, asyncio.TimeoutError):
+        return "deadline exceeded"
+    return str(e) or type(e).__name__
+
+def groq_retry_after(e):
+    headers = getattr(getattr(e, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+# attempt(model, claim) — bitta to'liq urinish. Hedging'da ikki urinish parallel ketadi:
+# claim() birinchi chaqirgan urinishga True qaytaradi (oqimdagi slaydlar faqat undan
+# ko'rsatiladi), qolgani bekor qilinadi. Har bir urinish (hedge, guruh, paket) umumiy
+# GROQ_CONCURRENCY limitidan joy oladi.
+class GroqCaller:
+    def __init__(self, models, concurrency):
+        self.models   = models
+        self.breakers = {m: CircuitBreaker(m, GROQ_BREAKER_FAILURES, GROQ_BREAKER_RESET) for m in models}
+        self.limit    = asyncio.Semaphore(concurrency)
+        self.active   = 0
+
+    async def call(self, attempt, mode):
+        deadline, last_error = time.monotonic() + GROQ_TOTAL_TIMEOUT, None
+        for model in self.models:
+            breaker = self.breakers[model]
+            for n in range(GROQ_RETRIES + 1):
+                if not breaker.allow():
+                    GROQ_ATTEMPTS.inc(model=model, outcome='circuit_open')
+                    break
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise GroqUnavailable(
+                        f"umumiy vaqt tugadi (deadline exceeded): {groq_error_text(last_error)}") from last_error
+                try:
+                    result = await self._race(attempt, model, mode, min(GROQ_ATTEMPT_TIMEOUT, left))
+                except Exception as e:
+                    kind = groq_error_kind(e)
+                    if kind is None:
+                        raise
+                    last_error = e
+                    # Hedging'da ikki so'rov ham xato bo'lsa ham bitta mantiqiy urinish.
+                    # 4xx — bizning so'rovimiz xatosi, model sog' — circuit'ga ta'sir qilmaydi.
+                    if kind != 'client':
+                        breaker.failure()
+                else:
+                    breaker.success()
+                    return result
+                if kind == 'client' or n == GROQ_RETRIES:
+                    break   # bu model bilan qayta urinish foyda bermaydi
+                delay = min(GROQ_BACKOFF_MAX, GROQ_BACKOFF_BASE * 2 ** n) * random.uniform(0.5, 1)
+                hint  = groq_retry_after(last_error)
+                if hint is not None:
+                    if hint > GROQ_BACKOFF_MAX:
+                        break
+                    delay = max(delay, hint)
+                if time.monotonic() + delay >= deadline:
+                    break
+                await asyncio.sleep(delay)
+        raise GroqUnavailable(f"barcha modellar ishlamadi: {groq_error_text(last_error)}") from last_error
+
+    async def _race(self, attempt, model, mode, timeout):
+        tasks, winner = [], None
+
+        def claimer(i):
+            def claim():
+                nonlocal winner
+                if winner is None:
+                    winner = i
+                    for j, task in enumerate(tasks):
+                        if j != i:
+                            task.cancel()
+                return winner == i
+            return claim
+
+        tasks.append(asyncio.ensure_future(self._attempt(attempt, model, mode, timeout, claimer(0))))
+        try:
+            if 0 < GROQ_HEDGE_AFTER < timeout and not self.breakers[model].is_open:
+                await asyncio.wait(tasks, timeout=GROQ_HEDGE_AFTER)
+                # Limit to'la bo'lsa qo'shimcha so'rov faqat navbatni uzaytiradi
+                if not tasks[0].done() and winner is None and not self.limit.locked():
+                    GROQ_HEDGES.inc(model=model)
+                    logger.info(f"🐌 Groq {model}: {GROQ_HEDGE_AFTER:g}s javob yo'q, qo'shimcha so'rov")
+                    tasks.append(asyncio.ensure_future(self._attempt(
+                        attempt, model, mode, timeout - GROQ_HEDGE_AFTER, claimer(1))))
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.cancelled():
+                        continue
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            # Hamma urinish tashqaridan bekor qilingan bo'lsa — natija ham, xato ham yo'q
+            raise error or GroqUnavailable(f"{model}: so'rovlar bekor qilindi")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _attempt(self, attempt, model, mode, timeout, claim):
+        async with self.limit:
+            self.active += 1
+            try:
+                return await self._attempt_locked(attempt, model, mode, timeout, claim)
+            finally:
+                self.active -= 1
+
+    async def _attempt_locked(self, attempt, model, mode, timeout, claim):
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(attempt(model, claim), timeout)
+        except asyncio.CancelledError:
+            GROQ_ATTEMPTS.inc(model=model, outcome='cancelled')
+            raise
+        except Exception as e:
+            kind = groq_error_kind(e)
+            if kind is None:
+                raise
+            GROQ_ATTEMPTS.inc(model=model, outcome=kind)
+            logger.warning(f"⚠️ Groq {model} ({mode}) {kind}, {time.perf_counter() - started:.1f}s: "
+                           f"{groq_error_text(e)}")
+            raise
+        finally:
+            GROQ_LATENCY.observe(time.perf_counter() - started, model=model, mode=mode)
+        GROQ_ATTEMPTS.inc(model=model, outcome='ok')
+        return result
+
+groq_caller = GroqCaller([GROQ_MODEL] + [m for m in GROQ_FALLBACK_MODELS if m != GROQ_MODEL], GROQ_CONCURRENCY)
+
+# --- 4. DATABASE (asyncpg pool) ---
+# Tez-tez ishlatiladigan so'rovlar. asyncpg ularni har bir ulanishda prepared
+# statement sifatida keshlaydi, shuning uchun matni o'zgarmas bo'lishi kerak.
+SQL_GET_USER       = "SELECT * FROM users WHERE id = $1"
+# Kunlik hisoblagichni oshirish (daily_stats) — boshqa statement'lar ichida CTE sifatida
+SQL_BUMP_STATS = """
+    ON CONFLICT (day, metric, key) DO UPDATE SET value = daily_stats.value + EXCLUDED.value
+"""
+# Balans o'zgarishi, ledger yozuvi va kunlik statistika bitta statement'da
+# (bitta round trip, bitta tranzaksiya)
+SQL_CREDIT = """
+    WITH upd AS (
+        UPDATE users SET balance = balance + $2::int WHERE id = $1 RETURNING id, balance
+    ), led AS (
+        INSERT INTO balance_ledger (user_id, delta, balance_after, reason, ref)
+        SELECT id, $2::int, balance, $3, $4 FROM upd
+        RETURNING balance_after
+    ), st AS (
+        INSERT INTO daily_stats (day, metric, key, value)
+        SELECT CURRENT_DATE, 'ledger', $3, $2::int FROM upd
+    """ + SQL_BUMP_STATS + """
+    )
+    SELECT balance_after FROM led
+"""
+# Faqat balans yetarli bo'lsa yechadi; aks holda hech narsa o'zgarmaydi va NULL qaytadi
+SQL_DEBIT = """
+    WITH upd AS (
+        UPDATE users SET balance = balance - $2::int
+        WHERE id = $1 AND balance >= $2::int RETURNING id, balance
+    ), led AS (
+        INSERT INTO balance_ledger (user_id, delta, balance_after, reason, ref)
+        SELECT id, -$2::int, balance, $3, $4 FROM upd
+        RETURNING balance_after
+    ), st AS (
+        INSERT INTO daily_stats (day, metric, key, value)
+        SELECT CURRENT_DATE, 'ledger', $3, -$2::int FROM upd
+    """ + SQL_BUMP_STATS + """
+    )
+    SELECT balance_after FROM led
+"""
+
+# Yangi ulanish ochilganda oldindan tayyorlanadigan (faqat o'qiydigan) so'rovlar
+HOT_READ_QUERIES = (SQL_GET_USER,)
+
+# Versiyalangan migratsiyalar: (versiya, nom, SQL). Qo'llanganlari schema_migrations'da
+# saqlanadi; sxema o'zgarishi faqat ro'yxat oxiriga yangi versiya sifatida qo'shiladi.
+# 1 — dastlabki sxema (users, referrals, payments); 2–5 — keyin qo'shilgan jadvallar.
+# Hammasi IF NOT EXISTS: migratsiyalardan oldingi bazalarda ham xavfsiz bajariladi.
+MIGRATION_LOCK_ID = 71200101   # pg_advisory_lock kaliti
+MIGRATIONS = (
+    (1, "baseline", """
+        CREATE TABLE IF NOT EXISTS users (
+            id          BIGINT PRIMARY KEY,
+            username    TEXT,
+            first_name  TEXT,
+            last_name   TEXT,
+            lang        TEXT    DEFAULT 'uz',
+            is_premium  INTEGER DEFAULT 0,
+            balance     INTEGER DEFAULT 2,
+            invited_by  BIGINT,
+            created_at  TIMESTAMP DEFAULT NOW(),
+            last_active TIMESTAMP DEFAULT NOW()
+        );
+
+        CREATE TABLE IF NOT EXISTS referrals (
+            id          SERIAL PRIMARY KEY,
+            referrer_id BIGINT,
+            referred_id BIGINT UNIQUE,
+            created_at  TIMESTAMP DEFAULT NOW()
+        );
+
+        CREATE TABLE IF NOT EXISTS payments (
+            id            SERIAL PRIMARY KEY,
+            user_id       BIGINT,
+            amount        INTEGER,
+            package_type  TEXT,
+            screenshot_id TEXT,
+            status        TEXT DEFAULT 'pending',
+            created_at    TIMESTAMP DEFAULT NOW()
+        );
+    """),
+    (2, "broadcasts", """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id                  SERIAL PRIMARY KEY,
+            admin_id            BIGINT,
+            lang                TEXT    DEFAULT 'uz',
+            from_chat_id        BIGINT,
+            message_id          BIGINT,
+            progress_message_id BIGINT,
+            last_user_id        BIGINT  DEFAULT 0,
+            total               INTEGER DEFAULT 0,
+            sent                INTEGER DEFAULT 0,
+            failed              INTEGER DEFAULT 0,
+            status              TEXT    DEFAULT 'running',
+            created_at          TIMESTAMP DEFAULT NOW(),
+            updated_at          TIMESTAMP DEFAULT NOW()
+        );
+    """),
+    (3, "balance_ledger", """
+        -- Append-only: faqat INSERT qilinadi, balanslarni users'ni skanerlamasdan tekshirish uchun
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id            BIGSERIAL PRIMARY KEY,
+            user_id       BIGINT  NOT NULL,
+            delta         INTEGER NOT NULL,
+            balance_after INTEGER NOT NULL,
+            reason        TEXT    NOT NULL,
+            ref           TEXT,
+            created_at    TIMESTAMP DEFAULT NOW()
+        );
+
+        CREATE INDEX IF NOT EXISTS balance_ledger_user_idx ON balance_ledger (user_id, id);
+
+        -- Ledger yangi yaratilganda mavjud balanslar 'opening' yozuvi sifatida kiritiladi
+        INSERT INTO balance_ledger (user_id, delta, balance_after, reason)
+        SELECT id, balance, balance, 'opening' FROM users
+        WHERE NOT EXISTS (SELECT 1 FROM balance_ledger);
+    """),
+    (4, "fsm_states", """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            chat_id    BIGINT NOT NULL,
+            user_id    BIGINT NOT NULL,
+            state      TEXT,
+            data       JSONB  NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (chat_id, user_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS fsm_states_updated_idx ON fsm_states (updated_at);
+    """),
+    (5, "daily_stats", """
+        -- Kunlik hisoblagichlar: yozuvchi statement'lar o'zi oshiradi, statistika
+        -- so'rovlari users'ni skanerlamaydi. metric/key misollari: signups/'',
+        -- referrals/'', ledger/<reason>, payments/<paket>, generations/regular|premium
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day    DATE   NOT NULL,
+            metric TEXT   NOT NULL,
+            key    TEXT   NOT NULL DEFAULT '',
+            value  BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, metric, key)
+        );
+
+        -- Birinchi marta: mavjud ma'lumotlardan bir martalik to'ldirish
+        INSERT INTO daily_stats (day, metric, key, value)
+        SELECT * FROM (
+            SELECT COALESCE(created_at::date, CURRENT_DATE) AS day, 'signups' AS metric,
+                   '' AS key, COUNT(*)::bigint AS value FROM users GROUP BY 1
+            UNION ALL
+            SELECT COALESCE(created_at::date, CURRENT_DATE), 'referrals', '', COUNT(*)
+            FROM referrals GROUP BY 1
+            UNION ALL
+            SELECT COALESCE(created_at::date, CURRENT_DATE), 'ledger', reason, SUM(delta)
+            FROM balance_ledger GROUP BY 1, 3
+            UNION ALL
+            SELECT COALESCE(created_at::date, CURRENT_DATE), 'payments',
+                   COALESCE(package_type, ''), COUNT(*) FROM payments GROUP BY 1, 3
+            UNION ALL
+            SELECT COALESCE(created_at::date, CURRENT_DATE), 'revenue',
+                   COALESCE(package_type, ''), COALESCE(SUM(amount), 0) FROM payments GROUP BY 1, 3
+            UNION ALL
+            SELECT CURRENT_DATE, 'premium', '', COUNT(*) FROM users WHERE is_premium = 1
+        ) s
+        WHERE NOT EXISTS (SELECT 1 FROM daily_stats);
+    """),
+    (6, "hot_query_indexes", """
+        CREATE INDEX IF NOT EXISTS referrals_referrer_idx ON referrals (referrer_id);
+        CREATE INDEX IF NOT EXISTS payments_user_idx ON payments (user_id);
+        CREATE INDEX IF NOT EXISTS payments_status_idx ON payments (status);
+    """),
+    # Profil va taklif ekranlari COUNT(*) o'rniga users qatoridagi hisoblagichni o'qiydi.
+    # Trigger referrals'ga har qanday yozuvda uni moslab turadi.
+    (7, "users_referral_count", """
+        LOCK TABLE referrals IN SHARE ROW EXCLUSIVE MODE;
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_count INTEGER NOT NULL DEFAULT 0;
+        CREATE OR REPLACE FUNCTION referrals_count_sync() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE users SET referral_count = referral_count + 1 WHERE id = NEW.referrer_id;
+            ELSE
+                UPDATE users SET referral_count = referral_count - 1 WHERE id = OLD.referrer_id;
+            END IF;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS referrals_count_sync ON referrals;
+        CREATE TRIGGER referrals_count_sync AFTER INSERT OR DELETE ON referrals
+            FOR EACH ROW EXECUTE FUNCTION referrals_count_sync();
+        UPDATE users u SET referral_count = r.cnt
+        FROM (SELECT referrer_id, COUNT(*) AS cnt FROM referrals GROUP BY referrer_id) r
+        WHERE u.id = r.referrer_id;
+    """),
+    # Yuborilgan taqdimotlar: deck_hash (render kirishlari xeshi) -> Telegram file_id.
+    # last_used bo'yicha eng eskilari o'chiriladi (LRU).
+    (8, "deck_files", """
+        CREATE TABLE IF NOT EXISTS deck_files (
+            deck_hash  TEXT PRIMARY KEY,
+            file_id    TEXT    NOT NULL,
+            size       INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT NOW(),
+            last_used  TIMESTAMP DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS deck_files_last_used_idx ON deck_files (last_used);
+    """),
+    # Bir nechta instance: users qatori o'zgarsa NOTIFY yuboriladi, boshqa instance'lar
+    # get_user keshidan shu yozuvni o'chiradi. last_active (ActivityTracker) hisobga olinmaydi.
+    (9, "users_notify", """
+        CREATE OR REPLACE FUNCTION users_notify_change() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('users_changed', (CASE TG_OP WHEN 'DELETE' THEN OLD.id ELSE NEW.id END)::text);
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS users_notify_update ON users;
+        CREATE TRIGGER users_notify_update AFTER UPDATE ON users FOR EACH ROW
+            WHEN ((OLD.balance, OLD.is_premium, OLD.lang, OLD.referral_count,
+                   OLD.username, OLD.first_name, OLD.last_name)
+                  IS DISTINCT FROM
+                  (NEW.balance, NEW.is_premium, NEW.lang, NEW.referral_count,
+                   NEW.username, NEW.first_name, NEW.last_name))
+            EXECUTE FUNCTION users_notify_change();
+        DROP TRIGGER IF EXISTS users_notify_delete ON users;
+        CREATE TRIGGER users_notify_delete AFTER DELETE ON users FOR EACH ROW
+            EXECUTE FUNCTION users_notify_change();
+    """),
+)
+USERS_CHANNEL = 'users_changed'
+
 class Database:
-    def __init__(self, dsn):
-        self.dsn = dsn
+    def __init__(self, dsn, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX):
+        self.dsn      = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool     = None
+        self.users    = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        # Har bir yozuvda oshadi: yozuvdan oldin boshlangan o'qish keshni eskirgan
+        # qator bilan to'ldirib qo'ymasligi uchun
+        self._user_epoch = 0
+        # save_deck_file har DECK_PRUNE_EVERY ta yozuvdan keyin tozalaydi
+        self._deck_saves = 0
+        # Pool ulanishlarining backend PID'lari: o'z yozuvlarimiz keshda allaqachon yangilangan
+        self._own_pids   = set()
+        self._listen_task = None
+
+    async def _setup_connection(self, conn):
+        pid = conn.get_server_pid()
+        self._own_pids.add(pid)
+        conn.add_termination_listener(lambda c: self._own_pids.discard(pid))
+        await conn.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+        # Hot so'rovlarni statement keshiga yuklab qo'yamiz
+        try:
+            for sql in HOT_READ_QUERIES:
+                await conn.fetchrow(sql, 0)
+        except asyncpg.UndefinedTableError:
+            pass  # birinchi ishga tushishda jadvallar hali yo'q
 
-    def _connect(self):
-        return psycopg2.connect(self.dsn, sslmode='require',
-                                cursor_factory=psycopg2.extras.RealDictCursor)
+    async def connect(self):
+        if self.pool is not None:
+            return
+        self.pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            ssl=None if DB_SSL == 'disable' else DB_SSL,
+            command_timeout=DB_QUERY_TIMEOUT,
+            max_inactive_connection_lifetime=DB_IDLE_LIFETIME,
+            statement_cache_size=DB_STMT_CACHE_SIZE,
+            init=self._setup_connection,
+        )
+        logger.info(f"✅ DB pool: min={self.min_size}, max={self.max_size}")
+
+    async def close(self):
+        if self._listen_task is not None:
+            self._listen_task.cancel()
+            await asyncio.gather(self._listen_task, return_exceptions=True)
+            self._listen_task = None
+        if self.pool is None:
+            return
+        pool, self.pool = self.pool, None
+        try:
+            await asyncio.wait_for(pool.close(), timeout=DB_QUERY_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("DB pool yopilmadi, majburan to'xtatilmoqda")
+            pool.terminate()
+        logger.info("🛑 DB pool yopildi.")
+
+    async def ping(self):
+        if self.pool is None:
+            return False
+        try:
+            async with self.pool.acquire(timeout=DB_QUERY_TIMEOUT) as conn:
+                return await conn.fetchval("SELECT 1", timeout=DB_QUERY_TIMEOUT) == 1
+        except Exception as e:
+            logger.warning(f"DB health xato: {e}")
+            return False
 
-    def _run_sync(self, fn):
-        loop = asyncio.get_event_loop()
-        return loop.run_in_executor(None, fn)
+    def pool_stats(self):
+        if self.pool is None:
+            return {'size': 0, 'idle': 0, 'max': self.max_size}
+        return {'size': self.pool.get_size(),
+                'idle': self.pool.get_idle_size(),
+                'max':  self.max_size}
+
+    async def _schema_version(self, conn):
+        try:
+            return await conn.fetchval("SELECT MAX(version) FROM schema_migrations") or 0
+        except asyncpg.UndefinedTableError:
+            return 0
 
     async def init(self):
-        def _init():
-            conn = self._connect()
-            with conn.cursor() as cur:
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        id          BIGINT PRIMARY KEY,
-                        username    TEXT,
-                        first_name  TEXT,
-                        last_name   TEXT,
-                        lang        TEXT    DEFAULT 'uz',
-                        is_premium  INTEGER DEFAULT 0,
-                        balance     INTEGER DEFAULT 2,
-                        invited_by  BIGINT,
-                        created_at  TIMESTAMP DEFAULT NOW(),
-                        last_active TIMESTAMP DEFAULT NOW()
-                    )
-                """)
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS referrals (
-                        id          SERIAL PRIMARY KEY,
-                        referrer_id BIGINT,
-                        referred_id BIGINT UNIQUE,
-                        created_at  TIMESTAMP DEFAULT NOW()
-                    )
-                """)
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS payments (
-                        id            SERIAL PRIMARY KEY,
-                        user_id       BIGINT,
-                        amount        INTEGER,
-                        package_type  TEXT,
-                        screenshot_id TEXT,
-                        status        TEXT DEFAULT 'pending',
-                        created_at    TIMESTAMP DEFAULT NOW()
+        await self.connect()
+        async with self.pool.acquire() as conn:
+            # Odatiy restart: sxema allaqachon oxirgi versiyada — lock va DDL'siz bitta so'rov
+            if await self._schema_version(conn) >= MIGRATIONS[-1][0]:
+                logger.info(f"✅ PostgreSQL baza tayyor (sxema v{MIGRATIONS[-1][0]}).")
+                return
+            # Bir nechta instance bir vaqtda ishga tushsa, migratsiyani faqat bittasi bajaradi
+            await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+            try:
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version    INTEGER PRIMARY KEY,
+                        name       TEXT NOT NULL,
+                        applied_at TIMESTAMP DEFAULT NOW()
                     )
                 """)
-            conn.commit()
-            conn.close()
-        await self._run_sync(_init)
+                applied = {r['version'] for r in await conn.fetch("SELECT version FROM schema_migrations")}
+                pending = [m for m in MIGRATIONS if m[0] not in applied]
+                for version, name, sql in pending:
+                    async with conn.transaction():
+                        await conn.execute(sql)
+                        await conn.execute(
+                            "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name)
+                    logger.info(f"🧱 Migratsiya {version}: {name}")
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+        if pending:
+            # Ustunlar o'zgargan bo'lishi mumkin — keshlangan prepared statement'lar bilan
+            # ulanishlar yangilanadi
+            await self.pool.expire_connections()
         logger.info("✅ PostgreSQL baza tayyor.")
 
+    def _patch_cached_user(self, user_id, **fields):
+        self._user_epoch += 1
+        row = self.users.peek(user_id)
+        if row is not None:
+            self.users.set(user_id, {**row, **fields})
+
+    def invalidate_user(self, user_id):
+        self._user_epoch += 1
+        self.users.pop(user_id)
+
+    # Boshqa instance'lar yozgan o'zgarishlar: users trigger'idan NOTIFY (migratsiya 9)
+    def start_listener(self):
+        if self._listen_task is None and USER_CACHE_TTL > 0:
+            self._listen_task = asyncio.ensure_future(self._listen_users())
+
+    def _on_user_changed(self, conn, pid, channel, payload):
+        if pid not in self._own_pids:
+            self.invalidate_user(int(payload))
+
+    async def _listen_users(self):
+        delay = 1
+        while True:
+            conn, lost = None, asyncio.Event()
+            try:
+                conn = await asyncpg.connect(self.dsn, ssl=None if DB_SSL == 'disable' else DB_SSL,
+                                             timeout=DB_QUERY_TIMEOUT)
+                conn.add_termination_listener(lambda c: lost.set())
+                await conn.add_listener(USERS_CHANNEL, self._on_user_changed)
+                # Ulanish yo'q paytdagi xabarlar yo'qolgan bo'lishi mumkin — kesh to'liq tozalanadi
+                self._user_epoch += 1
+                self.users.clear()
+                delay = 1
+                await lost.wait()
+                logger.warning("users LISTEN ulanishi uzildi, qayta ulanmoqda")
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                logger.warning(f"users LISTEN ulanmadi, {delay}s dan keyin: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+            finally:
+                if conn is not None and not conn.is_closed():
+                    conn.terminate()
+
+    # Keshdagi dict umumiy — chaqiruvchi o'zgartirsa kesh buzilmasligi uchun nusxa qaytariladi
     async def get_user(self, user_id):
-        def _get():
-            conn = self._connect()
-            with conn.cursor() as cur:
-                cur.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-                row = cur.fetchone()
-            conn.close()
-            return row
-        return await self._run_sync(_get)
-
+        row = self.users.get(user_id)
+        if row is not None:
+            return dict(row)
+        epoch = self._user_epoch
+        rec   = await self.pool.fetchrow(SQL_GET_USER, user_id)
+        if rec is None:
+            return None
+        row = dict(rec)
+        if epoch == self._user_epoch:
+            self.users.set(user_id, row)
+        return dict(row)
+
+    # Bitta upsert: yangi foydalanuvchi bo'lsa signup ledger va referal ham shu statement'da
+    # yoziladi. Mavjud foydalanuvchi uchun hech narsa yozilmaydi (last_active — ActivityTracker).
     async def add_user(self, user_id, username, first_name, last_name, referrer_id=None):
-        def _add():
-            conn = self._connect()
-            try:
-                with conn.cursor() as cur:
-                    cur.execute("""
-                        INSERT INTO users (id, username, first_name, last_name, invited_by)
-                        VALUES (%s, %s, %s, %s, %s)
-                    """, (user_id, username, first_name, last_name, referrer_id))
-                    if referrer_id:
-                        cur.execute("""
-                            INSERT INTO referrals (referrer_id, referred_id)
-                            VALUES (%s, %s) ON CONFLICT (referred_id) DO NOTHING
-                        """, (referrer_id, user_id))
-                conn.commit()
-                conn.close()
-                return True
-            except psycopg2.errors.UniqueViolation:
-                conn.rollback()
-                with conn.cursor() as cur:
-                    cur.execute("UPDATE users SET last_active = NOW() WHERE id = %s", (user_id,))
-                conn.commit()
-                conn.close()
-                return False
-        return await self._run_sync(_add)
-
-    async def update_balance(self, user_id, amount):
-        def _upd():
-            conn = self._connect()
-            with conn.cursor() as cur:
-                cur.execute("UPDATE users SET balance = balance + %s WHERE id = %s", (amount, user_id))
-            conn.commit()
-            conn.close()
-        await self._run_sync(_upd)
+        inserted = await self.pool.fetchval("""
+            WITH ins AS (
+                INSERT INTO users (id, username, first_name, last_name, invited_by)
+                VALUES ($1, $2, $3, $4, $5)
+                ON CONFLICT (id) DO NOTHING
+                RETURNING id, balance
+            ), led AS (
+                INSERT INTO balance_ledger (user_id, delta, balance_after, reason)
+                SELECT id, balance, balance, 'signup' FROM ins
+            ), ref AS (
+                INSERT INTO referrals (referrer_id, referred_id)
+                SELECT $5, id FROM ins WHERE $5::bigint IS NOT NULL
+                ON CONFLICT (referred_id) DO NOTHING
+                RETURNING referred_id
+            ), st AS (
+                INSERT INTO daily_stats (day, metric, key, value)
+                SELECT CURRENT_DATE, 'signups', '', 1 FROM ins
+                UNION ALL SELECT CURRENT_DATE, 'ledger', 'signup', balance FROM ins
+                UNION ALL SELECT CURRENT_DATE, 'referrals', '', 1 FROM ref
+            """ + SQL_BUMP_STATS + """
+            )
+            SELECT EXISTS (SELECT 1 FROM ins)
+        """, user_id, username, first_name, last_name, referrer_id)
+        if inserted:
+            self.invalidate_user(user_id)
+            if referrer_id:
+                self.invalidate_user(referrer_id)   # referral_count o'zgardi
+        return inserted
+
+    async def touch_users(self, user_ids, timestamps):
+        await self.pool.execute("""
+            UPDATE users AS u SET last_active = to_timestamp(v.ts)::timestamp
+            FROM unnest($1::bigint[], $2::float8[]) AS v(id, ts)
+            WHERE u.id = v.id
+        """, user_ids, timestamps)
+
+    def _apply_balance(self, user_id, balance):
+        if balance is None:
+            self.invalidate_user(user_id)
+        else:
+            self._patch_cached_user(user_id, balance=balance)
+        return balance
+
+    # reason: 'generation', 'refund', 'referral', 'payment', 'adjust', ...
+    async def update_balance(self, user_id, amount, reason='adjust', ref=None):
+        balance = await self.pool.fetchval(SQL_CREDIT, user_id, amount, reason, ref)
+        return self._apply_balance(user_id, balance)
+
+    # Atomar yechish: yangi balans yoki (yetarli bo'lmasa) None qaytaradi
+    async def debit(self, user_id, amount, reason='generation', ref=None):
+        balance = await self.pool.fetchval(SQL_DEBIT, user_id, amount, reason, ref)
+        return self._apply_balance(user_id, balance)
+
+    async def get_ledger_totals(self, days=None):
+        since = "WHERE created_at >= NOW() - make_interval(days => $1)" if days else ""
+        args  = (days,) if days else ()
+        return await self.pool.fetch(f"""
+            SELECT reason, COUNT(*) AS cnt, COALESCE(SUM(delta), 0) AS total
+            FROM balance_ledger {since} GROUP BY reason ORDER BY reason
+        """, *args)
 
     async def set_premium(self, user_id):
-        def _upd():
-            conn = self._connect()
-            with conn.cursor() as cur:
-                cur.execute("UPDATE users SET is_premium = 1 WHERE id = %s", (user_id,))
-            conn.commit()
-            conn.close()
-        await self._run_sync(_upd)
+        await self.pool.execute("""
+            WITH upd AS (
+                UPDATE users SET is_premium = 1
+                WHERE id = $1 AND is_premium IS DISTINCT FROM 1 RETURNING id
+            )
+            INSERT INTO daily_stats (day, metric, key, value)
+            SELECT CURRENT_DATE, 'premium', '', 1 FROM upd
+        """ + SQL_BUMP_STATS, user_id)
+        self._patch_cached_user(user_id, is_premium=1)
 
     async def update_lang(self, user_id, lang):
-        def _upd():
-            conn = self._connect()
-            with conn.cursor() as cur:
-                cur.execute("UPDATE users SET lang = %s WHERE id = %s", (lang, user_id))
-            conn.commit()
-            conn.close()
-        await self._run_sync(_upd)
+        await self.pool.execute("UPDATE users SET lang = $2 WHERE id = $1", user_id, lang)
+        self._patch_cached_user(user_id, lang=lang)
 
     async def get_referral_count(self, user_id):
-        def _get():
-            conn = self._connect()
-            with conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) as cnt FROM referrals WHERE referrer_id = %s", (user_id,))
-                row = cur.fetchone()
-            conn.close()
-            return row['cnt'] if row else 0
-        return await self._run_sync(_get)
-
-    async def get_all_users(self):
-        def _get():
-            conn = self._connect()
-            with conn.cursor() as cur:
-                cur.execute("SELECT id FROM users")
-                rows = cur.fetchall()
-            conn.close()
-            return rows
-        return await self._run_sync(_get)
-
+        user = await self.get_user(user_id)
+        return user['referral_count'] if user else 0
+
+    async def get_user_ids_after(self, last_id, limit):
+        # Keyset pagination: OFFSET'siz, PRIMARY KEY indeksi bo'yicha
+        rows = await self.pool.fetch(
+            "SELECT id FROM users WHERE id > $1 ORDER BY id LIMIT $2", last_id, limit)
+        return [r['id'] for r in rows]
+
+    async def create_broadcast(self, admin_id, lang, from_chat_id, message_id):
+        return await self.pool.fetchrow("""
+            INSERT INTO broadcasts (admin_id, lang, from_chat_id, message_id, total)
+            VALUES ($1, $2, $3, $4, (SELECT COUNT(*) FROM users)) RETURNING *
+        """, admin_id, lang, from_chat_id, message_id)
+
+    async def save_broadcast(self, bid, **fields):
+        cols = ", ".join(f"{k} = ${i+2}" for i, k in enumerate(fields))
+        await self.pool.execute(
+            f"UPDATE broadcasts SET {cols}, updated_at = NOW() WHERE id = $1", bid, *fields.values())
+
+    async def get_running_broadcasts(self):
+        return await self.pool.fetch("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id")
+
+    async def fsm_get(self, chat_id, user_id, ttl):
+        return await self.pool.fetchrow("""
+            SELECT state, data FROM fsm_states
+            WHERE chat_id = $1 AND user_id = $2 AND updated_at > NOW() - make_interval(secs => $3)
+        """, chat_id, user_id, ttl)
+
+    async def fsm_put(self, chat_id, user_id, state, data):
+        await self.pool.execute("""
+            INSERT INTO fsm_states (chat_id, user_id, state, data, updated_at)
+            VALUES ($1, $2, $3, $4, NOW())
+            ON CONFLICT (chat_id, user_id)
+            DO UPDATE SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = NOW()
+        """, chat_id, user_id, state, data)
+
+    async def fsm_delete(self, chat_id, user_id):
+        await self.pool.execute(
+            "DELETE FROM fsm_states WHERE chat_id = $1 AND user_id = $2", chat_id, user_id)
+
+    # Eskirgan holatlarni kichik partiyalarda o'chiradi (uzoq lock'larsiz)
+    async def fsm_cleanup(self, ttl, batch):
+        total = 0
+        while True:
+            status = await self.pool.execute("""
+                DELETE FROM fsm_states WHERE ctid = ANY(ARRAY(
+                    SELECT ctid FROM fsm_states
+                    WHERE updated_at < NOW() - make_interval(secs => $1) LIMIT $2
+                ))
+            """, ttl, batch)
+            deleted = int(status.split()[-1])
+            total  += deleted
+            if deleted < batch:
+                return total
+
+    # Jami qiymatlar kunlik hisoblagichlar yig'indisi (users skanerlanmaydi)
     async def get_stats(self):
-        def _get():
-            conn = self._connect()
-            with conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) as total_users, COALESCE(SUM(balance),0) as total_slides FROM users")
-                row = cur.fetchone()
-                cur.execute("SELECT COUNT(*) as cnt FROM users WHERE is_premium = 1")
-                prow = cur.fetchone()
-            conn.close()
-            return {'total_users': row['total_users'],
-                    'total_slides': row['total_slides'],
-                    'premium_users': prow['cnt']}
-        return await self._run_sync(_get)
+        rows = await self.pool.fetch("""
+            SELECT metric, SUM(value)::bigint AS total FROM daily_stats
+            WHERE metric IN ('signups', 'ledger', 'premium') GROUP BY metric
+        """)
+        totals = {r['metric']: r['total'] for r in rows}
+        return {'total_users':   totals.get('signups', 0),
+                'total_slides':  totals.get('ledger', 0),
+                'premium_users': totals.get('premium', 0)}
+
+    async def get_daily_stats(self, days):
+        return await self.pool.fetch("""
+            SELECT day, metric, key, value FROM daily_stats
+            WHERE day > CURRENT_DATE - $1::int ORDER BY day
+        """, days)
+
+    # Hisoblagichlar bazaning CURRENT_DATE'i bo'yicha yoziladi — "bugun" ham bazadan
+    async def current_date(self):
+        return await self.pool.fetchval("SELECT CURRENT_DATE")
+
+    # items: (metric, key, value) — tranzaksiyasi bo'lmagan hodisalar uchun (masalan, tayyor taqdimot)
+    async def add_stats(self, *items):
+        metrics, keys, values = zip(*items)
+        await self.pool.execute("""
+            INSERT INTO daily_stats (day, metric, key, value)
+            SELECT CURRENT_DATE, m, k, v FROM unnest($1::text[], $2::text[], $3::bigint[]) AS s(m, k, v)
+        """ + SQL_BUMP_STATS, list(metrics), list(keys), list(values))
+
+    async def get_deck_file(self, deck_hash):
+        return await self.pool.fetchval("""
+            UPDATE deck_files SET last_used = NOW() WHERE deck_hash = $1 RETURNING file_id
+        """, deck_hash)
+
+    async def save_deck_file(self, deck_hash, file_id, size):
+        await self.pool.execute("""
+            INSERT INTO deck_files (deck_hash, file_id, size) VALUES ($1, $2, $3)
+            ON CONFLICT (deck_hash) DO UPDATE SET file_id = EXCLUDED.file_id,
+                size = EXCLUDED.size, last_used = NOW()
+        """, deck_hash, file_id, size)
+        self._deck_saves += 1
+        if self._deck_saves % DECK_PRUNE_EVERY == 0:
+            await self.prune_deck_files(DECK_CACHE_MAX)
+
+    async def delete_deck_file(self, deck_hash):
+        await self.pool.execute("DELETE FROM deck_files WHERE deck_hash = $1", deck_hash)
+
+    # Eng so'nggi `keep` ta yozuvdan tashqari hammasi o'chiriladi
+    async def prune_deck_files(self, keep):
+        status = await self.pool.execute("""
+            DELETE FROM deck_files WHERE deck_hash IN (
+                SELECT deck_hash FROM deck_files ORDER BY last_used DESC OFFSET $1
+            )
+        """, keep)
+        deleted = int(status.split()[-1])
+        if deleted:
+            logger.info(f"🧹 deck_files: {deleted} ta eski file_id o'chirildi")
+        return deleted
 
     async def add_payment(self, user_id, amount, package_type, screenshot_id):
-        def _add():
-            conn = self._connect()
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO payments (user_id, amount, package_type, screenshot_id)
-                    VALUES (%s, %s, %s, %s) RETURNING id
-                """, (user_id, amount, package_type, screenshot_id))
-                pid = cur.fetchone()['id']
-            conn.commit()
-            conn.close()
-            return pid
-        return await self._run_sync(_add)
+        return await self.pool.fetchval("""
+            WITH ins AS (
+                INSERT INTO payments (user_id, amount, package_type, screenshot_id)
+                VALUES ($1, $2, $3, $4) RETURNING id
+            ), st AS (
+                INSERT INTO daily_stats (day, metric, key, value)
+                SELECT CURRENT_DATE, 'payments', COALESCE($3, ''), 1 FROM ins
+                UNION ALL SELECT CURRENT_DATE, 'revenue', COALESCE($3, ''), COALESCE($2, 0) FROM ins
+            """ + SQL_BUMP_STATS + """
+            )
+            SELECT id FROM ins
+        """, user_id, amount, package_type, screenshot_id)
+
+# Har bir ommaviy metod o'lchanadi (keshdan qaytgan get_user ham)
+for _name, _fn in list(vars(Database).items()):
+    if not _name.startswith('_') and asyncio.iscoroutinefunction(_fn):
+        setattr(Database, _name, timed(DB_LATENCY, _fn, method=_name))
 
 db = Database(DATABASE_URL)
 
+# --- 4.1 FSM STORAGE ---
+# PostgreSQL'da saqlanadigan FSM: redeploy'dan keyin ham to'lov/broadcast holatlari
+# yo'qolmaydi va bir nechta instance bitta holatni ko'radi. Ixtiyoriy write-through LRU
+# (FSM_CACHE_TTL > 0) boshqa instance yozuvlarini bilmaydi — faqat bitta instance uchun.
+class PostgresStorage(BaseStorage):
+    def __init__(self, database, ttl=FSM_TTL, cache_size=FSM_CACHE_SIZE, cache_ttl=FSM_CACHE_TTL):
+        self.db    = database
+        self.ttl   = ttl
+        self.cache = TTLCache(cache_size, cache_ttl) if cache_ttl > 0 else None
+        self._task = None
+
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return int(chat), int(user)
+
+    async def _load(self, key):
+        rec = self.cache.get(key) if self.cache is not None else None
+        if rec is None:
+            row = await self.db.fsm_get(*key, self.ttl)
+            rec = {'state': row['state'], 'data': row['data']} if row else {'state': None, 'data': {}}
+            if self.cache is not None:
+                self.cache.set(key, rec)
+        return rec
+
+    async def _save(self, key, state, data):
+        if self.cache is not None:
+            self.cache.set(key, {'state': state, 'data': data})
+        if state is None and not data:
+            await self.db.fsm_delete(*key)
+        else:
+            await self.db.fsm_put(*key, state, data)
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        rec = await self._load(self._key(chat, user))
+        return rec['state'] or self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        rec = await self._load(self._key(chat, user))
+        return copy.deepcopy(rec['data'])
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key = self._key(chat, user)
+        rec = await self._load(key)
+        await self._save(key, self.resolve_state(state), rec['data'])
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key = self._key(chat, user)
+        rec = await self._load(key)
+        await self._save(key, rec['state'], copy.deepcopy(data or {}))
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        key = self._key(chat, user)
+        rec = await self._load(key)
+        new = copy.deepcopy(rec['data'])
+        new.update(data or {}, **kwargs)
+        await self._save(key, rec['state'], new)
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        key = self._key(chat, user)
+        rec = await self._load(key)
+        await self._save(key, None, {} if with_data else rec['data'])
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(FSM_CLEANUP_EVERY)
+            try:
+                deleted = await self.db.fsm_cleanup(self.ttl, FSM_CLEANUP_BATCH)
+                if deleted:
+                    logger.info(f"🧹 FSM: {deleted} ta eskirgan holat o'chirildi")
+            except Exception as e:
+                logger.warning(f"FSM tozalash xato: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._cleanup_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.cache is not None:
+            self.cache.clear()
+
+    async def wait_closed(self):
+        pass
+
+storage = PostgresStorage(db)
+dp      = Dispatcher(bot, storage=storage)
+
+# --- 4.2 FAOLLIK (write-behind) ---
+# Har bir update'da last_active xotirada yangilanadi va har ACTIVITY_FLUSH_EVERY
+# soniyada bitta UPDATE ... FROM unnest(...) bilan bazaga yoziladi.
+class ActivityTracker:
+    def __init__(self, interval):
+        self.interval = interval
+        self._seen    = {}   # user_id -> epoch
+        self._task    = None
+
+    def touch(self, user_id):
+        self._seen[user_id] = time.time()
+
+    async def flush(self):
+        if not self._seen:
+            return
+        batch, self._seen = self._seen, {}
+        try:
+            await db.touch_users(list(batch), list(batch.values()))
+        except Exception as e:
+            logger.warning(f"last_active yozilmadi ({len(batch)} ta): {e}")
+            for uid, ts in batch.items():   # keyingi flush'da qayta urinamiz
+                if ts > self._seen.get(uid, 0):
+                    self._seen[uid] = ts
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+def update_user_id(update: types.Update):
+    event = (update.message or update.callback_query or update.edited_message
+             or update.inline_query or update.my_chat_member or update.pre_checkout_query)
+    user  = getattr(event, 'from_user', None)
+    return user.id if user else None
+
+def update_chat_id(update: types.Update):
+    msg = update.message or update.edited_message or (
+        update.callback_query.message if update.callback_query else None)
+    if msg is not None:
+        return msg.chat.id
+    return update_user_id(update)
+
+class ActivityMiddleware(BaseMiddleware):
+    def __init__(self, tracker):
+        super().__init__()
+        self.tracker = tracker
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        uid = update_user_id(update)
+        if uid:
+            self.tracker.touch(uid)
+
+activity = ActivityTracker(ACTIVITY_FLUSH_EVERY)
+dp.middleware.setup(ActivityMiddleware(activity))
+
+# --- 4.3 THROTTLING ---
+# Suiiste'mol (flood, referal fermalar) DB va Groq'gacha yetmasligi uchun update
+# handler'lardan oldin to'xtatiladi. Ogohlantirish ham har foydalanuvchiga siyrak yuboriladi.
+def update_action(update: types.Update):
+    if update.callback_query:
+        data = update.callback_query.data or ''
+        return 'generate' if data.startswith(('gen:', 'batch:')) else 'message'
+    msg = update.message
+    if msg is None:
+        return None
+    if msg.is_command() and msg.get_command(pure=True) == 'start':
+        return 'start'
+    # To'lov cheki faqat rasm yoki hujjat; stiker, ovoz va boshqalar oddiy xabar
+    if msg.content_type in (types.ContentType.PHOTO, types.ContentType.DOCUMENT):
+        return 'payment'
+    return 'message'
+
+class ThrottleMiddleware(BaseMiddleware):
+    def __init__(self, throttle, notice_every, idle):
+        super().__init__()
+        self.throttle = throttle
+        self.notices  = KeyedBuckets(1 / notice_every, 1, idle)
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        action = update_action(update)
+        uid    = update_user_id(update)
+        if action is None or not uid or uid == ADMIN_ID:
+            return
+        scope = self.throttle.check(action, uid)
+        if scope is None:
+            return
+        THROTTLED.inc(action=action, scope=scope)
+        if self.notices.try_acquire(uid):
+            await self.notify(update, uid)
+        elif update.callback_query:
+            # Ogohlantirishsiz ham javob beriladi — aks holda tugma "yuklanmoqda" holatida qoladi
+            try:
+                await update.callback_query.answer()
+            except TelegramAPIError:
+                pass
+        raise CancelHandler()
+
+    async def notify(self, update, uid):
+        # Til faqat keshdan — cheklangan update bazaga murojaat qilmaydi
+        row  = db.users.peek(uid)
+        lang = row['lang'] if row else (update.message or update.callback_query).from_user.language_code
+        if lang not in LANGS:
+            lang = 'uz'
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(LANGS[lang]['throttled'])
+            else:
+                await bot.send_message(update.message.chat.id, LANGS[lang]['throttled'])
+        except TelegramAPIError as e:
+            logger.warning(f"Throttle xabari yuborilmadi: {e}")
+
+throttle = Throttle({'message':  THROTTLE_MESSAGE,  'generate': THROTTLE_GENERATE,
+                     'payment':  THROTTLE_PAYMENT,  'start':    THROTTLE_START}, THROTTLE_IDLE)
+if THROTTLE_ENABLED:
+    dp.middleware.setup(ThrottleMiddleware(throttle, THROTTLE_NOTICE_EVERY, THROTTLE_IDLE))
+
 # --- 5. PPTX GENERATOR ---
 def xml_escape(s):
     return str(s).replace('&','&amp;').replace('<','&lt;').replace('>','&gt;').replace('"','&quot;')
@@ -336,48 +1704,200 @@ def clean_json_string(text):
     except Exception:
         return text
 
-def create_presentation_file(topic, json_data, uid):
-    os.makedirs("slides", exist_ok=True)
-    timestamp  = int(time.time())
+def presentation_filename(topic, ext="pptx"):
     safe_topic = re.sub(r'[^\w\s-]', '', topic)[:30].strip()
-    pptx_path  = f"slides/{safe_topic}_{uid}_{timestamp}.pptx"
-    try:
-        data   = json.loads(clean_json_string(json_data))
-        slides = data.get('slides', [])
-
-        slide_ct = "\n".join([
-            f'    <Override PartName="/ppt/slides/slide{i+1}.xml" '
-            f'ContentType="application/vnd.openxmlformats-officedocument.presentationml.slide+xml"/>'
-            for i in range(len(slides))
-        ])
-        slide_rels_xml = "\n".join([
-            f'    <Relationship Id="rId{i+1}" '
-            f'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/slide" '
-            f'Target="slides/slide{i+1}.xml"/>'
-            for i in range(len(slides))
-        ])
-        slide_ids = "\n".join([
-            f'        <p:sldId id="{256+i}" r:id="rId{i+1}"/>'
-            for i in range(len(slides))
-        ])
-
-        with zipfile.ZipFile(pptx_path, 'w', zipfile.ZIP_DEFLATED) as pptx:
-            pptx.writestr('[Content_Types].xml', f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+    return f"{safe_topic or 'presentation'}.{ext}"
+
+# Render deterministik (zip vaqt belgilari qat'iy), shuning uchun fayl nomi va
+# slaydlar bir xil bo'lsa baytlar ham bir xil — xesh renderdan oldin hisoblanadi
+def deck_hash(filename, outline):
+    payload = json.dumps([RENDER_VERSION, filename, outline.get('slides', [])],
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+# AI javobini outline'ga aylantiradi. Buzilgan JSON avval tuzatib ko'riladi,
+# bo'lmasa oqim davomida to'liq kelgan slaydlar (partial) ishlatiladi.
+def parse_outline(text, partial=None):
+    for candidate in (clean_json_string(text), repair_json(text)):
+        try:
+            data = json.loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(data, dict) and isinstance(data.get('slides'), list) and data['slides']:
+            return data
+    if partial:
+        logger.warning(f"JSON buzilgan, {len(partial)} ta to'liq slayd ishlatiladi")
+        return {'slides': list(partial)}
+    raise ValueError("AI javobida slides yo'q")
+
+# Uzilib qolgan JSON'ni yopadi: ochiq satr, osilib qolgan vergul va qavslar
+def repair_json(text):
+    start = text.find('{')
+    if start == -1:
+        return text
+    body   = re.sub(r'\s*```\s*$', '', text[start:])
+    stack  = []
+    in_str = esc = False
+    for ch in body:
+        if in_str:
+            if esc:
+                esc = False
+            elif ch == '\\':
+                esc = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch in '{[':
+            stack.append('}' if ch == '{' else ']')
+        elif ch in '}]' and stack:
+            stack.pop()
+    if esc:
+        body = body[:-1]
+    if in_str:
+        body += '"'
+    body = re.sub(r'[\s,:]+$', '', body)
+    return body + "".join(reversed(stack))
+
+# Oqim (stream) bo'yicha kelayotgan {"slides":[...]} dan har bir to'liq slayd
+# obyektini darhol ajratib beradi. Buferni qayta skanerlamaydi.
+class SlideStreamParser:
+    def __init__(self):
+        self.buf       = ""
+        self.slides    = []
+        self.done      = False
+        self._pos      = None   # "slides" massivi ichidagi skaner pozitsiyasi
+        self._depth    = 0
+        self._in_str   = False
+        self._esc      = False
+        self._obj_from = None
+
+    def feed(self, chunk):
+        self.buf += chunk
+        new = []
+        if self._pos is None:
+            m = re.search(r'"slides"\s*:\s*\[', self.buf)
+            if not m:
+                return new
+            self._pos = m.end()
+        buf, i = self.buf, self._pos
+        while i < len(buf) and not self.done:
+            ch = buf[i]
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif ch == '\\':
+                    self._esc = True
+                elif ch == '"':
+                    self._in_str = False
+            elif ch == '"':
+                self._in_str = True
+            elif ch in '{[':
+                if self._depth == 0:
+                    self._obj_from = i
+                self._depth += 1
+            elif ch in '}]':
+                if self._depth == 0:
+                    self.done = True   # slides massivi yopildi
+                else:
+                    self._depth -= 1
+                    if self._depth == 0 and self._obj_from is not None:
+                        try:
+                            slide = json.loads(buf[self._obj_from:i+1])
+                        except ValueError:
+                            slide = None
+                        if isinstance(slide, dict):
+                            self.slides.append(slide)
+                            new.append(slide)
+                        self._obj_from = None
+            i += 1
+        self._pos = i
+        return new
+
+def render_slide_xml(i, slide):
+    title  = xml_escape(slide.get('title', f'Slide {i+1}'))
+    points = slide.get('points', [])
+    if isinstance(points, str):
+        points = [points]
+    points_xml = "".join([
+        f'\n                <a:p><a:r><a:t>• {xml_escape(p)}</a:t></a:r></a:p>'
+        for p in points
+    ])
+    return f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<p:sld xmlns:p="http://schemas.openxmlformats.org/presentationml/2006/main"
+       xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main"
+       xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+    <p:cSld><p:spTree>
+        <p:nvGrpSpPr><p:cNvPr id="1" name=""/><p:cNvGrpSpPr/><p:nvPr/></p:nvGrpSpPr>
+        <p:grpSpPr/>
+        <p:sp>
+            <p:nvSpPr><p:cNvPr id="2" name="Title"/><p:cNvSpPr><a:spLocks noGrp="1"/></p:cNvSpPr><p:nvPr><p:ph type="title"/></p:nvPr></p:nvSpPr>
+            <p:spPr/><p:txBody><a:bodyPr/><a:lstStyle/>
+                <a:p><a:r><a:rPr lang="uz-UZ" b="1"/><a:t>{title}</a:t></a:r></a:p>
+            </p:txBody>
+        </p:sp>
+        <p:sp>
+            <p:nvSpPr><p:cNvPr id="3" name="Content"/><p:cNvSpPr><a:spLocks noGrp="1"/></p:cNvSpPr><p:nvPr><p:ph idx="1"/></p:nvPr></p:nvSpPr>
+            <p:spPr/><p:txBody><a:bodyPr/><a:lstStyle/>{points_xml}
+            </p:txBody>
+        </p:sp>
+    </p:spTree></p:cSld>
+</p:sld>"""
+
+# Taqdimot xotirada quriladi: (fayl nomi, baytlar) qaytadi, diskka hech narsa yozilmaydi.
+# json_data: AI javobi (str) yoki tayyor outline (dict);
+# slide_parts: oqim davomida oldindan tayyorlangan slayd XML'lari (ixtiyoriy)
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+def _zip_write(zf, name, content):
+    info = zipfile.ZipInfo(name, date_time=ZIP_DATE_TIME)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o600 << 16
+    zf.writestr(info, content)
+
+def create_presentation_file(topic, json_data, uid, slide_parts=None):
+    filename = presentation_filename(topic)
+    buf      = io.BytesIO()
+    data     = json_data if isinstance(json_data, dict) else parse_outline(json_data)
+    slides   = data.get('slides', [])
+    if not slides:
+        raise ValueError("Bo'sh taqdimot")
+    if not slide_parts or len(slide_parts) != len(slides):
+        slide_parts = [render_slide_xml(i, slide) for i, slide in enumerate(slides)]
+
+    slide_ct = "\n".join([
+        f'    <Override PartName="/ppt/slides/slide{i+1}.xml" '
+        f'ContentType="application/vnd.openxmlformats-officedocument.presentationml.slide+xml"/>'
+        for i in range(len(slides))
+    ])
+    slide_rels_xml = "\n".join([
+        f'    <Relationship Id="rId{i+1}" '
+        f'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/slide" '
+        f'Target="slides/slide{i+1}.xml"/>'
+        for i in range(len(slides))
+    ])
+    slide_ids = "\n".join([
+        f'        <p:sldId id="{256+i}" r:id="rId{i+1}"/>'
+        for i in range(len(slides))
+    ])
+
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as pptx:
+        _zip_write(pptx, '[Content_Types].xml', f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
 <Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
     <Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
     <Default Extension="xml" ContentType="application/xml"/>
     <Override PartName="/ppt/presentation.xml" ContentType="application/vnd.openxmlformats-officedocument.presentationml.presentation.main+xml"/>
 {slide_ct}
 </Types>""")
-            pptx.writestr('_rels/.rels', """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+        _zip_write(pptx, '_rels/.rels', """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
 <Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
     <Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="ppt/presentation.xml"/>
 </Relationships>""")
-            pptx.writestr('ppt/_rels/presentation.xml.rels', f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+        _zip_write(pptx, 'ppt/_rels/presentation.xml.rels', f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
 <Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
 {slide_rels_xml}
 </Relationships>""")
-            pptx.writestr('ppt/presentation.xml', f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+        _zip_write(pptx, 'ppt/presentation.xml', f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
 <p:presentation xmlns:p="http://schemas.openxmlformats.org/presentationml/2006/main"
                 xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
     <p:sldMasterIdLst/>
@@ -388,77 +1908,876 @@ def create_presentation_file(topic, json_data, uid):
     <p:notesSz cx="6858000" cy="9144000"/>
 </p:presentation>""")
 
-            for i, slide in enumerate(slides):
-                title  = xml_escape(slide.get('title', f'Slide {i+1}'))
-                points = slide.get('points', [])
-                if isinstance(points, str):
-                    points = [points]
-                points_xml = "".join([
-                    f'\n                <a:p><a:r><a:t>• {xml_escape(p)}</a:t></a:r></a:p>'
-                    for p in points
-                ])
-                pptx.writestr(f'ppt/slides/slide{i+1}.xml', f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
-<p:sld xmlns:p="http://schemas.openxmlformats.org/presentationml/2006/main"
-       xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main"
-       xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
-    <p:cSld><p:spTree>
-        <p:nvGrpSpPr><p:cNvPr id="1" name=""/><p:cNvGrpSpPr/><p:nvPr/></p:nvGrpSpPr>
-        <p:grpSpPr/>
-        <p:sp>
-            <p:nvSpPr><p:cNvPr id="2" name="Title"/><p:cNvSpPr><a:spLocks noGrp="1"/></p:cNvSpPr><p:nvPr><p:ph type="title"/></p:nvPr></p:nvSpPr>
-            <p:spPr/><p:txBody><a:bodyPr/><a:lstStyle/>
-                <a:p><a:r><a:rPr lang="uz-UZ" b="1"/><a:t>{title}</a:t></a:r></a:p>
-            </p:txBody>
-        </p:sp>
-        <p:sp>
-            <p:nvSpPr><p:cNvPr id="3" name="Content"/><p:cNvSpPr><a:spLocks noGrp="1"/></p:cNvSpPr><p:nvPr><p:ph idx="1"/></p:nvPr></p:nvSpPr>
-            <p:spPr/><p:txBody><a:bodyPr/><a:lstStyle/>{points_xml}
-            </p:txBody>
-        </p:sp>
-    </p:spTree></p:cSld>
-</p:sld>""")
-                pptx.writestr(f'ppt/slides/_rels/slide{i+1}.xml.rels',
-                    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"/>')
+        for i, part in enumerate(slide_parts):
+            _zip_write(pptx, f'ppt/slides/slide{i+1}.xml', part)
+            _zip_write(pptx, f'ppt/slides/_rels/slide{i+1}.xml.rels',
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"/>')
+
+    data = buf.getvalue()
+    logger.info(f"✅ PPTX: {filename} ({len(data)} bayt, uid={uid})")
+    return filename, data
+
+# --- 5.1 RENDER POOL ---
+class RenderQueueFull(Exception):
+    pass
+
+class RenderPool:
+    def __init__(self, workers, max_pending, timeout):
+        self.workers     = workers
+        self.max_pending = max_pending
+        self.timeout     = timeout
+        self.pending     = 0
+        self._executor   = None
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            logger.info(f"✅ Render pool: {self.workers} ta jarayon")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def render(self, topic, json_data, uid, slide_parts=None):
+        if self.pending >= self.max_pending:
+            raise RenderQueueFull()
+        self.start()
+        loop = asyncio.get_running_loop()
+        try:
+            cfut = self._executor.submit(create_presentation_file, topic, json_data, uid, slide_parts)
+        except BrokenProcessPool:
+            logger.error("Render pool buzildi, qayta yaratiladi")
+            self.shutdown()
+            raise
+        # Timeout'da worker jarayoni o'z ishini tugatadi — joy shundan keyingina bo'shaydi,
+        # aks holda uzoq renderlar ustiga max_pending'dan ko'p ish yuborilib qoladi
+        self.pending += 1
+        cfut.add_done_callback(lambda _: self._release(loop))
+        try:
+            with RENDER_LATENCY.time():
+                return await asyncio.wait_for(asyncio.wrap_future(cfut), self.timeout)
+        except BrokenProcessPool:
+            logger.error("Render pool buzildi, qayta yaratiladi")
+            self.shutdown()
+            raise
+
+    def _release(self, loop):
+        def release():
+            self.pending -= 1
+        try:
+            loop.call_soon_threadsafe(release)
+        except RuntimeError:   # loop yopilgan (shutdown)
+            pass
+
+render_pool = RenderPool(RENDER_WORKERS, RENDER_QUEUE_MAX, RENDER_TIMEOUT)
+
+# --- 5.2 OUTLINE KESH ---
+def normalize_topic(topic):
+    t = unicodedata.normalize('NFKC', topic).casefold()
+    t = re.sub(r'[^\w\s]', ' ', t)
+    return " ".join(t.split())
+
+def outline_key(topic, num_slides, lang, model=GROQ_MODEL):
+    raw = json.dumps([normalize_topic(topic), num_slides, lang, model, PROMPT_VERSION])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+# Xotiradagi LRU/TTL + ixtiyoriy SQLite fayl (restartdan keyin ham saqlanadi).
+# Har bir kalit uchun OUTLINE_VARIANTS tagacha variant saqlanadi.
+class OutlineCache:
+    def __init__(self, maxsize, ttl, path=None):
+        self.mem     = TTLCache(maxsize, ttl)
+        self.maxsize = maxsize
+        self.ttl     = ttl
+        self.path    = path
+        self._conn   = None
+        self._lock   = threading.Lock()
+        self._saves  = 0
+
+    def open(self):
+        if not self.path or self._conn is not None:
+            return
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS outlines (
+                    key      TEXT PRIMARY KEY,
+                    variants TEXT NOT NULL,
+                    saved_at REAL NOT NULL,
+                    used_at  REAL NOT NULL
+                )
+            """)
+        self._prune()
+        logger.info(f"✅ Outline kesh: {self.path}")
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+    def _prune(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM outlines WHERE saved_at < ?", (time.time() - self.ttl,))
+            self._conn.execute("""
+                DELETE FROM outlines WHERE key NOT IN
+                    (SELECT key FROM outlines ORDER BY used_at DESC LIMIT ?)
+            """, (self.maxsize,))
+
+    def _load(self, key):
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT variants FROM outlines WHERE key = ? AND saved_at >= ?",
+                (key, time.time() - self.ttl)).fetchone()
+            if row:
+                self._conn.execute("UPDATE outlines SET used_at = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0]) if row else None
+
+    def _save(self, key, variants):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO outlines (key, variants, saved_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(variants, ensure_ascii=False), now, now))
+            self._saves += 1
+            prune = OUTLINE_PRUNE_EVERY > 0 and self._saves % OUTLINE_PRUNE_EVERY == 0
+        # Uzoq ishlayotgan jarayonda fayl cheksiz o'smasligi uchun
+        if prune:
+            self._prune()
+
+    async def get(self, key):
+        variants = self.mem.get(key)
+        if variants is None and self._conn is not None:
+            variants = await asyncio.to_thread(self._load, key)
+            if variants:
+                self.mem.set(key, variants)
+        return variants
+
+    async def add(self, key, outline):
+        variants = (self.mem.peek(key) or [])[-(OUTLINE_VARIANTS - 1):] if OUTLINE_VARIANTS > 1 else []
+        variants = variants + [outline]
+        self.mem.set(key, variants)
+        if self._conn is not None:
+            try:
+                await asyncio.to_thread(self._save, key, variants)
+            except sqlite3.Error as e:
+                logger.warning(f"Outline kesh yozish xato: {e}")
 
-        logger.info(f"✅ PPTX: {pptx_path}")
-        return pptx_path
-    except Exception as e:
-        logger.error(f"PPTX xato: {e}", exc_info=True)
-        txt = f"slides/fallback_{uid}_{int(time.time())}.txt"
-        with open(txt, 'w', encoding='utf-8') as f:
-            f.write(f"Topic: {topic}\nTime: {datetime.now()}\n")
-        return txt
+outline_cache = OutlineCache(OUTLINE_CACHE_SIZE, OUTLINE_CACHE_TTL, OUTLINE_CACHE_PATH)
+
+def outline_messages(prompt):
+    return [
+        {"role": "system", "content": "You are a presentation creator. Return valid JSON only."},
+        {"role": "user",   "content": prompt}
+    ]
+
+def parse_titles(text):
+    for candidate in (clean_json_string(text), repair_json(text)):
+        try:
+            data = json.loads(candidate)
+        except ValueError:
+            continue
+        titles = data.get('titles') if isinstance(data, dict) else None
+        if isinstance(titles, list):
+            titles = [str(t).strip() for t in titles if str(t).strip()]
+            if titles:
+                return titles
+    raise ValueError("AI javobida titles yo'q")
+
+# on_slide(n, slide): oqim rejimida har bir to'liq slayd kelganda chaqiriladi
+async def request_outline(topic, num_slides, on_slide=None):
+    prompt = (
+        f'Create a presentation on: "{topic}". '
+        f'Return ONLY valid JSON: {{"slides":[{{"title":"...","points":["..."]}}]}} '
+        f'Generate exactly {num_slides} slides. No extra text.'
+    )
+    messages = outline_messages(prompt)
+
+    async def attempt(model, claim):
+        if not GROQ_STREAM:
+            response = await groq_client().chat.completions.create(
+                model=model, messages=messages, temperature=0.7, max_tokens=4000)
+            return parse_outline(response.choices[0].message.content)
+
+        parser = SlideStreamParser()
+        stream = await groq_client().chat.completions.create(
+            model=model, messages=messages, temperature=0.7, max_tokens=4000, stream=True)
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            for slide in parser.feed(delta):
+                if on_slide is not None and claim():
+                    await on_slide(len(parser.slides), slide)
+        return parse_outline(parser.buf, parser.slides)
+
+    return await groq_caller.call(attempt, 'stream' if GROQ_STREAM else 'full')
+
+# Ikki bosqich: qisqa so'rov sarlavhalarni beradi, so'ng EXPAND_GROUP tadan guruhlar
+# parallel to'ldiriladi. Har bir javob max_tokens'dan ancha kichik — JSON uzilmaydi.
+# on_slide tartib bilan chaqiriladi: guruh oldingilari tayyor bo'lganda chiqariladi.
+async def request_outline_expanded(topic, num_slides, on_slide=None):
+    async def titles_attempt(model, claim):
+        response = await groq_client().chat.completions.create(
+            model=model, temperature=0.7, max_tokens=1000, messages=outline_messages(
+                f'Create slide titles for a presentation on: "{topic}". '
+                f'Return ONLY valid JSON: {{"titles":["..."]}} '
+                f'Generate exactly {num_slides} titles. No extra text.'))
+        return parse_titles(response.choices[0].message.content)
+
+    titles = (await groq_caller.call(titles_attempt, 'titles'))[:num_slides]
+    groups = [titles[i:i + EXPAND_GROUP] for i in range(0, len(titles), EXPAND_GROUP)]
+
+    async def expand(group):
+        numbered = "\n".join(f"{i + 1}. {t}" for i, t in enumerate(group))
+
+        async def attempt(model, claim):
+            response = await groq_client().chat.completions.create(
+                model=model, temperature=0.7, max_tokens=4000, messages=outline_messages(
+                    f'Write slides for a presentation on: "{topic}". '
+                    f'Use these slide titles, in this order:\n{numbered}\n'
+                    f'Return ONLY valid JSON: {{"slides":[{{"title":"...","points":["..."]}}]}} '
+                    f'Generate exactly {len(group)} slides. No extra text.'))
+            slides = parse_outline(response.choices[0].message.content)['slides'][:len(group)]
+            for slide, title in zip(slides, group):
+                if isinstance(slide, dict) and not slide.get('title'):
+                    slide['title'] = title
+            return slides
+
+        return await groq_caller.call(attempt, 'expand')
+
+    tasks = [asyncio.ensure_future(expand(group)) for group in groups]
+    slides, dropped, error = [], [], None
+    try:
+        for i, task in enumerate(tasks):
+            try:
+                group = await task
+            except (GroqUnavailable, ValueError) as e:
+                # Keyingi guruhlar parallel davom etadi, bu guruh bir marta qayta so'raladi
+                logger.warning(f"Slaydlar guruhi to'ldirilmadi, qayta urinilmoqda: {e}")
+                try:
+                    group = await expand(groups[i])
+                except (GroqUnavailable, ValueError) as e:
+                    # Guruh tashlab yuboriladi: slaydlar tartibi saqlanadi, foydalanuvchiga qaysi
+                    # qism chiqarilgani aytiladi, yetishmagan slaydlar GenJob'da qaytariladi
+                    logger.warning(f"Slaydlar guruhi qayta urinishda ham to'ldirilmadi: {e}")
+                    error = e
+                    first = i * EXPAND_GROUP + 1
+                    dropped.append((first, first + len(groups[i]) - 1))
+                    continue
+            for slide in group:
+                slides.append(slide)
+                if on_slide is not None:
+                    await on_slide(len(slides), slide)
+    finally:
+        for task in tasks:
+            task.cancel()
+    if not slides:
+        raise error
+    if dropped:
+        return {'slides': slides, 'dropped': dropped}
+    return {'slides': slides}
+
+# Tashlab yuborilgan guruhlar (rejadagi slayd raqamlari) -> "6–10, 16–20"
+def format_dropped(dropped):
+    return ", ".join(f"{a}–{b}" if a != b else str(a) for a, b in dropped)
+
+async def generate_outline(topic, num_slides, lang, on_slide=None):
+    key      = outline_key(topic, num_slides, lang)
+    variants = await outline_cache.get(key)
+    if variants:
+        want_new = len(variants) < OUTLINE_VARIANTS and random.random() < OUTLINE_VARIETY
+        if not want_new:
+            return random.choice(variants)
+    if num_slides >= EXPAND_MIN_SLIDES:
+        outline = await request_outline_expanded(topic, num_slides, on_slide)
+    else:
+        outline = await request_outline(topic, num_slides, on_slide)
+    if len(outline['slides']) >= num_slides:   # uzilib qolgan (tuzatilgan) javob keshlanmaydi
+        await outline_cache.add(key, outline)
+    return outline
+
+# --- 5.3 GENERATSIYA NAVBATI ---
+class SchedulerBusy(Exception):
+    pass
+
+class JobAlreadyActive(Exception):
+    pass
+
+class GenJob:
+    def __init__(self, uid, lang, is_premium, topic, num_slides, charged, message):
+        self.uid        = uid
+        self.lang       = lang
+        self.is_premium = is_premium
+        self.topic      = topic
+        self.num_slides = num_slides
+        self.charged    = charged   # yechilgan slaydlar — xato yoki bekor bo'lsa qaytariladi
+        self.message    = message
+        self.wait_msg   = None
+        self.key        = None
+        self.position   = 0
+        self._progress_at = 0.0
+
+    async def refund(self, amount=None):
+        amount = self.charged if amount is None else min(amount, self.charged)
+        if amount > 0:
+            self.charged -= amount
+            await db.update_balance(self.uid, amount, 'refund', self.topic[:100])
+            REFUNDED_SLIDES.inc(amount)
+
+    async def progress(self, n):
+        now = time.monotonic()
+        if now - self._progress_at < PROGRESS_EDIT_EVERY:
+            return
+        self._progress_at = now
+        await self.set_status(LANGS[self.lang]['progress'].format(n=n, total=self.num_slides))
+
+    async def set_status(self, text):
+        if self.wait_msg is None:
+            return
+        try:
+            await self.wait_msg.edit_text(text)
+        except MessageNotModified:
+            pass
+        except TelegramAPIError as e:
+            logger.warning(f"Wait xabarini yangilab bo'lmadi: {e}")
+
+    async def _close_wait(self):
+        if self.wait_msg is not None:
+            try:
+                await self.wait_msg.delete()
+            except TelegramAPIError:
+                pass
+
+    # Xuddi shu taqdimot avval yuborilgan bo'lsa — qayta render va yuklashsiz, file_id bilan
+    async def _send_cached(self, key, caption):
+        try:
+            file_id = await db.get_deck_file(key)
+        except Exception as e:
+            logger.warning(f"deck_files o'qilmadi: {e}")
+            file_id = None
+        if file_id is None:
+            DECK_REUSE.inc(result='miss')
+            return False
+        try:
+            await self.message.answer_document(file_id, caption=caption)
+        except BadRequest as e:
+            # file_id yaroqsiz (masalan, bot tokeni almashgan) — yozuv o'chiriladi, fayl qayta yuklanadi
+            logger.warning(f"file_id ishlamadi, qayta yuklanadi: {e}")
+            DECK_REUSE.inc(result='stale')
+            try:
+                await db.delete_deck_file(key)
+            except Exception:
+                pass
+            return False
+        DECK_REUSE.inc(result='hit')
+        return True
+
+    async def _remember_deck(self, key, sent, size):
+        if sent is None or sent.document is None:
+            return
+        try:
+            await db.save_deck_file(key, sent.document.file_id, size)
+        except Exception as e:
+            logger.warning(f"file_id saqlanmadi: {e}")
+
+    async def run(self):
+        l = self.lang
+        if self.position:
+            await self.set_status(LANGS[l]['wait'])
+        streamed, parts = [], []
+        started, outcome = time.perf_counter(), 'error'
+
+        async def on_slide(n, slide):
+            # Slayd XML'i oqim davom etayotganda tayyorlanadi, render faqat zip qiladi
+            streamed.append(slide)
+            parts.append(render_slide_xml(n - 1, slide))
+            await self.progress(n)
+
+        try:
+            outline = await generate_outline(self.topic, self.num_slides, l, on_slide=on_slide)
+            if outline['slides'] != streamed:
+                parts = None
+            missing = self.num_slides - len(outline['slides'])
+            if missing > 0:
+                await self.refund(missing)
+            caption = LANGS[l]['done']
+            if outline.get('dropped'):
+                caption += LANGS[l]['dropped'].format(slides=format_dropped(outline['dropped']))
+            key = deck_hash(presentation_filename(self.topic), outline)
+            # Yuborilgandan keyin charged = 0: shutdown paytidagi kech bekor qilish pul qaytarmaydi
+            if await self._send_cached(key, caption):
+                self.charged = 0
+            else:
+                filename, content = await render_pool.render(self.topic, outline, self.uid, parts)
+                sent = await self.message.answer_document(
+                    InputFile(io.BytesIO(content), filename=filename), caption=caption)
+                self.charged = 0
+                await self._remember_deck(key, sent, len(content))
+            outcome = 'ok'
+            await self._close_wait()
+            try:
+                await db.add_stats(('generations', 'premium' if self.is_premium else 'regular', 1))
+            except Exception as e:
+                logger.warning(f"Statistika yozilmadi: {e}")
+
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            await self.refund()
+            raise
+
+        except RenderQueueFull:
+            outcome = 'busy'
+            logger.warning(f"Render navbati to'la, uid={self.uid}")
+            await self.refund()
+            await self.message.answer(LANGS[l]['busy'])
+            await self._close_wait()
+
+        except GroqUnavailable as e:
+            outcome = 'unavailable'
+            logger.error(f"Groq mavjud emas, uid={self.uid}: {e}")
+            await self.refund()
+            await self.message.answer(LANGS[l]['busy'])
+            await self._close_wait()
+
+        except Exception as e:
+            logger.error(f"AI xato: {e}", exc_info=True)
+            await self.refund()
+            await self.message.answer(LANGS[l]['error'])
+            await self._close_wait()
+
+        finally:
+            GENERATIONS.inc(outcome=outcome)
+            GEN_LATENCY.observe(time.perf_counter() - started, outcome=outcome)
+
+    async def drop(self):
+        GENERATIONS.inc(outcome='dropped')
+        await self.refund()
+        try:
+            await self.message.answer(LANGS[self.lang]['busy'])
+        except TelegramAPIError:
+            pass
+        await self._close_wait()
+
+# Bir nechta mavzu bitta ishda: taqdimotlar BATCH_CONCURRENCY tadan parallel tayyorlanadi
+# va tayyor bo'lishi bilan ZIP arxivga yoziladi. BATCH_CONCURRENCY faqat xotira va render
+# navbatini cheklaydi — Groq so'rovlari baribir umumiy GROQ_CONCURRENCY limitidan o'tadi.
+# Jarayon bitta xabarda ko'rsatiladi, tayyorlanmagan mavzularning slaydlari qaytariladi.
+class BatchJob(GenJob):
+    def __init__(self, uid, lang, is_premium, topics, num_slides, charged, message):
+        super().__init__(uid, lang, is_premium, f"batch {len(topics)}x{num_slides}: {topics[0]}",
+                         num_slides, charged, message)
+        self.topics = topics
+        self.done   = 0
+        self.failed = 0
+
+    async def progress(self, n=None):
+        now = time.monotonic()
+        if now - self._progress_at < PROGRESS_EDIT_EVERY:
+            return
+        self._progress_at = now
+        await self.set_status(LANGS[self.lang]['batch_progress'].format(done=self.done, total=len(self.topics)))
+
+    async def _one(self, index, topic, archive):
+        owed = self.num_slides
+        try:
+            outline = await generate_outline(topic, self.num_slides, self.lang)
+            missing = self.num_slides - len(outline['slides'])
+            if missing > 0:
+                await self.refund(missing)
+                owed -= missing
+            filename, content = await render_pool.render(topic, outline, self.uid)
+        except Exception as e:
+            logger.warning(f"Paketdagi mavzu tayyorlanmadi ({topic[:40]}): {e}")
+            self.failed += 1
+            await self.refund(owed)
+            return
+        archive.writestr(f"{index + 1:02d} {filename}", content)
+        self.done += 1
+        await self.progress()
+
+    async def run(self):
+        l, total = self.lang, len(self.topics)
+        started, outcome = time.perf_counter(), 'error'
+        limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+        # Arxiv xotirada yig'iladi: Telegram'ga baribir butun fayl yuklanadi, hajmi esa
+        # BATCH_MAX_TOPICS × bitta PPTX bilan cheklangan
+        buf   = io.BytesIO()
+
+        async def one(index, topic):
+            async with limit:
+                await self._one(index, topic, archive)
+
+        try:
+            await self.set_status(LANGS[l]['batch_progress'].format(done=0, total=total))
+            # PPTX allaqachon siqilgan — arxivda qayta siqilmaydi
+            with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as archive:
+                await asyncio.gather(*(one(i, topic) for i, topic in enumerate(self.topics)))
+            if not self.done:
+                await self.message.answer(LANGS[l]['error'])
+                await self._close_wait()
+                return
+            caption = LANGS[l]['batch_done'].format(done=self.done, total=total)
+            if self.failed:
+                caption += LANGS[l]['batch_failed'].format(failed=self.failed)
+            buf.seek(0)
+            await self.message.answer_document(InputFile(buf, filename=f"taqdimotlar_{total}.zip"),
+                                               caption=caption)
+            self.charged = 0
+            outcome = 'partial' if self.failed else 'ok'
+            logger.info(f"📦 Paket: {self.done}/{total} taqdimot, uid={self.uid}")
+            await self._close_wait()
+            try:
+                await db.add_stats(('generations', 'premium' if self.is_premium else 'regular', self.done))
+            except Exception as e:
+                logger.warning(f"Statistika yozilmadi: {e}")
+
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            await self.refund()
+            raise
+
+        except Exception as e:
+            logger.error(f"Paket xato: {e}", exc_info=True)
+            await self.refund()
+            await self.message.answer(LANGS[l]['error'])
+            await self._close_wait()
+
+        finally:
+            GENERATIONS.inc(outcome=outcome)
+            GEN_LATENCY.observe(time.perf_counter() - started, outcome=outcome)
+
+# Global parallellik chegarasi, har bir foydalanuvchiga bitta faol ish,
+# premium foydalanuvchilar navbatda oldinda turadi.
+class GenerationScheduler:
+    def __init__(self, concurrency, max_queue):
+        self.concurrency  = concurrency
+        self.max_queue    = max_queue
+        self.running      = 0
+        self.active_users = set()   # navbatdagi yoki ishlayotgan
+        self.pending      = {}      # job -> key (faqat navbatdagilar)
+        self._queue       = asyncio.PriorityQueue()
+        self._seq         = itertools.count()
+        self._tasks       = []
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)]
+        self._tasks.append(asyncio.ensure_future(self._position_updater()))
+        logger.info(f"✅ Generatsiya navbati: {self.concurrency} worker, navbat {self.max_queue}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Navbatda qolgan ishlar bekor qilinadi va balans qaytariladi
+        dropped = list(self.pending)
+        self.pending.clear()
+        for job in dropped:
+            self.active_users.discard(job.uid)
+            await job.drop()
+
+    @property
+    def saturated(self):
+        return self.running + len(self.pending) >= self.concurrency
+
+    def reserve(self, uid):
+        if uid in self.active_users:
+            raise JobAlreadyActive()
+        if len(self.active_users) - self.running >= self.max_queue:
+            raise SchedulerBusy()
+        self.active_users.add(uid)
+
+    def release(self, uid):
+        self.active_users.discard(uid)
+
+    def queue_position(self, is_premium):
+        # Hozir qo'shiladigan ish navbatda nechanchi bo'lishi
+        lane = 0 if is_premium else 1
+        return 1 + sum(1 for k in self.pending.values() if k[0] <= lane)
+
+    def submit(self, job):
+        job.key = (0 if job.is_premium else 1, next(self._seq))
+        self.pending[job] = job.key
+        self._queue.put_nowait((job.key, job))
+
+    async def _worker(self):
+        while True:
+            _, job = await self._queue.get()
+            if self.pending.pop(job, None) is None:
+                continue   # stop() tomonidan bekor qilingan
+            self.running += 1
+            try:
+                await job.run()
+            except Exception as e:
+                logger.error(f"Generatsiya ishi xato: {e}", exc_info=True)
+            finally:
+                self.running -= 1
+                self.active_users.discard(job.uid)
+
+    async def _position_updater(self):
+        while True:
+            await asyncio.sleep(GEN_POSITION_EVERY)
+            edits = 0
+            for pos, job in enumerate(sorted(self.pending, key=lambda j: j.key), 1):
+                if edits >= GEN_POSITION_EDITS:
+                    break
+                if job.position and job.position != pos:
+                    job.position = pos
+                    edits += 1
+                    await job.set_status(LANGS[job.lang]['queued'].format(pos=pos))
+
+gen_scheduler = GenerationScheduler(GEN_CONCURRENCY, GEN_QUEUE_MAX)
 
 # --- 6. HELPERS ---
-async def check_sub(user_id):
+sub_cache     = TTLCache(SUB_CACHE_SIZE, SUB_CACHE_POS_TTL)
+_sub_inflight = {}   # user_id -> Future: bir vaqtdagi so'rovlar bitta API chaqiruvga birlashadi
+
+async def _fetch_sub(user_id):
     try:
         member = await bot.get_chat_member(CHANNEL_ID, user_id)
-        return member.status in ['creator', 'administrator', 'member']
     except Exception as e:
         logger.warning(f"Kanal tekshiruv xato: {e}")
-        return False
+        return False   # xatoni keshlamaymiz
+    is_member = member.status in ['creator', 'administrator', 'member']
+    sub_cache.set(user_id, is_member, ttl=None if is_member else SUB_CACHE_NEG_TTL)
+    return is_member
+
+async def check_sub(user_id, force=False):
+    if not force:
+        cached = sub_cache.get(user_id)
+        if cached is not None:
+            return cached
+    fut = _sub_inflight.get(user_id)
+    if fut is None:
+        fut = asyncio.ensure_future(_fetch_sub(user_id))
+        _sub_inflight[user_id] = fut
+        fut.add_done_callback(lambda _: _sub_inflight.pop(user_id, None))
+    # shield: bitta kutuvchi bekor qilinsa, qolganlar uchun so'rov davom etadi
+    return await asyncio.shield(fut)
 
 async def send_sub_message(message: types.Message, lang):
-    ikb = InlineKeyboardMarkup().add(
-        InlineKeyboardButton(LANGS[lang]['btn_join'], url=f"https://t.me/{CHANNEL_ID[1:]}"),
-        InlineKeyboardButton(LANGS[lang]['btn_check'], callback_data="check_sub")
-    )
-    await message.answer(f"{LANGS[lang]['sub_err']}\n\n{CHANNEL_ID}", reply_markup=ikb)
+    await message.answer(f"{LANGS[lang]['sub_err']}\n\n{CHANNEL_ID}", reply_markup=SUB_IKB[lang])
 
 async def show_main_menu(message: types.Message, lang):
-    b  = LANGS[lang]['btns']
-    kb = ReplyKeyboardMarkup(resize_keyboard=True).add(
-        KeyboardButton(b[0]), KeyboardButton(b[1])
-    ).add(
-        KeyboardButton(b[2]), KeyboardButton(b[3])
-    ).add(KeyboardButton(b[4]))
-    await message.answer(LANGS[lang]['welcome'], reply_markup=kb)
-
-def remove_file(path):
+    await message.answer(LANGS[lang]['welcome'], reply_markup=MAIN_KB[lang])
+
+async def referral_link(uid):
+    me = await bot.me   # aiogram get_me natijasini keshlaydi
+    return f"https://t.me/{me.username}?start={uid}"
+
+# Paket faqat ro'yxat bo'lsa: har bir qator "1." / "1)" / "-" / "•" bilan boshlanadi.
+# Oddiy ko'p qatorli matn (sarlavha + izoh) bitta mavzu hisoblanadi — bo'sh ro'yxat qaytadi.
+LIST_ITEM_RE = re.compile(r'^\s*(?:\d+[.)]|[-•*])\s+(.*\S)')
+
+def split_topics(text):
+    lines = [line for line in text.splitlines() if line.strip()]
+    items = [LIST_ITEM_RE.match(line) for line in lines]
+    if len(lines) < 2 or not all(items):
+        return []
+    return [m.group(1).strip() for m in items][:BATCH_MAX_TOPICS]
+
+# Navbatga qo'shish: oddiy foydalanuvchidan `cost` slayd bitta tranzaksiyada yechiladi,
+# xato yoki bekor bo'lsa ish o'zi qaytaradi
+async def enqueue_job(job, cost):
+    l, uid, message = job.lang, job.uid, job.message
     try:
-        os.remove(path)
-    except Exception:
-        pass
+        gen_scheduler.reserve(uid)
+    except JobAlreadyActive:
+        return await message.answer(LANGS[l]['already_running'])
+    except SchedulerBusy:
+        return await message.answer(LANGS[l]['busy'])
+
+    try:
+        if not job.is_premium:
+            if await db.debit(uid, cost, 'generation', job.topic[:100]) is None:
+                gen_scheduler.release(uid)
+                return await message.answer(LANGS[l]['no_bal'])
+            job.charged = cost
+        if gen_scheduler.saturated:
+            job.position = gen_scheduler.queue_position(job.is_premium)
+            job.wait_msg = await message.answer(LANGS[l]['queued'].format(pos=job.position))
+        else:
+            job.wait_msg = await message.answer(LANGS[l]['wait'])
+        gen_scheduler.submit(job)
+    except Exception as e:
+        logger.error(f"Navbatga qo'shish xato: {e}", exc_info=True)
+        gen_scheduler.release(uid)
+        await job.refund()
+        await message.answer(LANGS[l]['error'])
+
+# --- 6.1 BROADCAST ---
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+broadcast_tasks  = {}   # broadcast id -> asyncio.Task
+
+class BroadcastJob:
+    def __init__(self, row):
+        self.id                  = row['id']
+        self.admin_id            = row['admin_id']
+        self.lang                = row['lang'] if row['lang'] in LANGS else 'uz'
+        self.from_chat_id        = row['from_chat_id']
+        self.message_id          = row['message_id']
+        self.progress_message_id = row['progress_message_id']
+        self.last_user_id        = row['last_user_id']
+        self.total               = row['total']
+        self.sent                = row['sent']
+        self.failed              = row['failed']
+        self._reported_at        = 0.0
+
+    async def _deliver(self, user_id):
+        for _ in range(BROADCAST_MAX_RETRIES):
+            await broadcast_bucket.acquire()
+            try:
+                await bot.copy_message(user_id, self.from_chat_id, self.message_id)
+                return True
+            except RetryAfter as e:
+                logger.warning(f"Broadcast #{self.id}: RetryAfter {e.timeout}s")
+                broadcast_bucket.penalize(e.timeout)
+            except (Unauthorized, ChatNotFound):
+                return False   # bloklagan / o'chirilgan foydalanuvchi
+            except Exception as e:
+                logger.error(f"Broadcast xato {user_id}: {e}")
+                return False
+        return False
+
+    async def _report(self, force=False):
+        now = time.monotonic()
+        if not self.progress_message_id or (not force and now - self._reported_at < BROADCAST_REPORT_EVERY):
+            return
+        self._reported_at = now
+        text = LANGS[self.lang]['broadcast_progress'].format(
+            id=self.id, sent=self.sent, total=self.total, failed=self.failed)
+        try:
+            await bot.edit_message_text(text, self.admin_id, self.progress_message_id)
+        except MessageNotModified:
+            pass
+        except TelegramAPIError as e:
+            logger.warning(f"Broadcast #{self.id} progress xato: {e}")
+
+    async def _send_one(self, sem, user_id):
+        async with sem:
+            ok = await self._deliver(user_id)
+        if ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+        BROADCAST_MSGS.inc(result='sent' if ok else 'failed')
+        await self._report()
+
+    async def run(self):
+        logger.info(f"📢 Broadcast #{self.id} boshlandi (last_user_id={self.last_user_id})")
+        sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        try:
+            while True:
+                ids = await db.get_user_ids_after(self.last_user_id, BROADCAST_PAGE_SIZE)
+                if not ids:
+                    break
+                await asyncio.gather(*(self._send_one(sem, uid) for uid in ids))
+                # Sahifa to'liq yuborilgach checkpoint: qayta ishga tushganda shu yerdan davom etadi
+                self.last_user_id = ids[-1]
+                await db.save_broadcast(self.id, last_user_id=self.last_user_id,
+                                        sent=self.sent, failed=self.failed)
+        except asyncio.CancelledError:
+            logger.info(f"⏸ Broadcast #{self.id} to'xtatildi, keyingi ishga tushishda davom etadi")
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast #{self.id} xato: {e}", exc_info=True)
+            await db.save_broadcast(self.id, status='failed', sent=self.sent, failed=self.failed)
+            return
+        await db.save_broadcast(self.id, status='done', sent=self.sent, failed=self.failed)
+        await self._report(force=True)
+        try:
+            await bot.send_message(self.admin_id, LANGS[self.lang]['broadcast_sent'].format(count=self.sent))
+        except TelegramAPIError as e:
+            logger.error(f"Broadcast #{self.id} yakuniy xabar xato: {e}")
+        logger.info(f"✅ Broadcast #{self.id}: {self.sent} yuborildi, {self.failed} xato")
+
+def _spawn_broadcast(row):
+    job  = BroadcastJob(row)
+    task = asyncio.ensure_future(job.run())
+    broadcast_tasks[job.id] = task
+    task.add_done_callback(lambda _: broadcast_tasks.pop(job.id, None))
+    return job
+
+async def start_broadcast(message: types.Message, lang):
+    row = await db.create_broadcast(message.from_user.id, lang, message.chat.id, message.message_id)
+    progress = await message.answer(LANGS[lang]['broadcast_progress'].format(
+        id=row['id'], sent=0, total=row['total'], failed=0))
+    await db.save_broadcast(row['id'], progress_message_id=progress.message_id)
+    row = {**row, 'progress_message_id': progress.message_id}
+    return _spawn_broadcast(row)
+
+async def resume_broadcasts():
+    for row in await db.get_running_broadcasts():
+        logger.info(f"🔁 Broadcast #{row['id']} tiklanmoqda")
+        _spawn_broadcast(row)
+
+async def stop_broadcasts():
+    tasks = list(broadcast_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# --- 6.2 STATISTIKA ---
+# daily_stats qatorlari kun bo'yicha jamlanadi: {sana: {(metric, key): qiymat}}
+def pivot_daily(rows):
+    days = {}
+    for r in rows:
+        days.setdefault(r['day'], {})[(r['metric'], r['key'])] = r['value']
+    return days
+
+def _metric_sum(day, metric):
+    return sum(v for (m, _), v in day.items() if m == metric)
+
+def daily_summary(day):
+    signups   = day.get(('signups', ''), 0)
+    referrals = day.get(('referrals', ''), 0)
+    return {
+        'signups':         signups,
+        'referrals':       referrals,
+        'referral_rate':   round(referrals / signups, 3) if signups else 0,
+        'generations':     _metric_sum(day, 'generations'),
+        # yechilgan minus qaytarilgan slaydlar
+        'slides_consumed': -(day.get(('ledger', 'generation'), 0) + day.get(('ledger', 'refund'), 0)),
+        'payments':        _metric_sum(day, 'payments'),
+        'revenue':         _metric_sum(day, 'revenue'),
+    }
+
+def stats_dashboard(rows, days, today):
+    daily = pivot_daily(rows)
+    lines = [f"{'Sana':<6}{'Yangi':>6}{'Ref':>5}{'Gen':>5}{'Slayd':>6}" + " To'lov"]
+    for i in range(days - 1, -1, -1):
+        day = today - timedelta(days=i)
+        s   = daily_summary(daily.get(day, {}))
+        lines.append(f"{day:%d.%m}{s['signups']:>6}{s['referrals']:>5}{s['generations']:>5}"
+                     f"{s['slides_consumed']:>6}{s['payments']:>7}")
+    packages = {}
+    for day in daily.values():
+        for (metric, key), value in day.items():
+            if metric == 'payments':
+                packages[key] = packages.get(key, 0) + value
+    pkg = ", ".join(f"{k or '—'}: {v}" for k, v in sorted(packages.items())) or "—"
+    return "```\n" + "\n".join(lines) + "\n```\n💳 Paketlar: " + pkg
+
+def stats_csv(rows):
+    daily   = pivot_daily(rows)
+    reasons = sorted({k for d in daily.values() for (m, k) in d if m == 'ledger'})
+    pkgs    = sorted({k for d in daily.values() for (m, k) in d if m == 'payments'})
+    buf     = io.StringIO()
+    writer  = csv.writer(buf)
+    base    = list(daily_summary({}))
+    writer.writerow(['day', *base, *(f"payments:{p}" for p in pkgs), *(f"revenue:{p}" for p in pkgs),
+                     *(f"ledger:{r}" for r in reasons)])
+    for day in sorted(daily):
+        d = daily[day]
+        s = daily_summary(d)
+        writer.writerow([day.isoformat(), *(s[k] for k in base),
+                         *(d.get(('payments', p), 0) for p in pkgs),
+                         *(d.get(('revenue', p), 0) for p in pkgs),
+                         *(d.get(('ledger', r), 0) for r in reasons)])
+    return buf.getvalue().encode('utf-8')
 
 # --- 7. HANDLERLAR ---
 
@@ -479,7 +2798,7 @@ async def start_cmd(message: types.Message, state: FSMContext):
     is_new = await db.add_user(user_id, user.username, user.first_name, user.last_name, referrer_id)
 
     if is_new and referrer_id:
-        await db.update_balance(referrer_id, 1)
+        await db.update_balance(referrer_id, 1, 'referral', str(user_id))
         try:
             await bot.send_message(referrer_id,
                 "🎉 **Tabriklaymiz!**\nSizning havolangiz orqali yangi foydalanuvchi qo'shildi.\n💰 **+1 slayd** qo'shildi!")
@@ -496,7 +2815,7 @@ async def start_cmd(message: types.Message, state: FSMContext):
 @dp.callback_query_handler(lambda c: c.data == 'check_sub', state='*')
 async def check_sub_callback(callback: CallbackQuery, state: FSMContext):
     uid = callback.from_user.id
-    if await check_sub(uid):
+    if await check_sub(uid, force=True):
         await callback.message.delete()
         user = await db.get_user(uid)
         if not user:
@@ -529,29 +2848,22 @@ async def main_handler(message: types.Message, state: FSMContext):
         return
 
     current_state = await state.get_state()
-    l    = user['lang']
-    btns = LANGS[l]['btns']
-    text = message.text
+    l      = user['lang']
+    text   = message.text
+    action = BUTTON_ROUTES.get(text)
 
     # Package choice state
     if current_state == 'UserStates:waiting_package_choice':
-        package_btns = LANGS[l]['package_btns']
-        price_map = {
-            package_btns[0]: ("1_slide",     990),
-            package_btns[1]: ("5_slides",   2999),
-            package_btns[2]: ("vip_premium", 5999),
-        }
-        if text in price_map:
-            pkg, amount = price_map[text]
+        package = PACKAGE_BY_TEXT.get(text)
+        if package:
+            pkg, amount = package
             await state.update_data(chosen_package=pkg, amount=amount)
             await UserStates.waiting_for_payment.set()
             await message.answer(
                 f"💳 To'lov summasi: {amount:,} so'm\n📸 To'lov chekini yuboring.",
-                reply_markup=ReplyKeyboardMarkup(resize_keyboard=True).add(
-                    KeyboardButton(LANGS[l]['cancel'])
-                )
+                reply_markup=CANCEL_KB[l]
             )
-        elif text == LANGS[l]['cancel']:
+        elif action == 'cancel':
             await state.finish()
             await show_main_menu(message, l)
         else:
@@ -560,42 +2872,31 @@ async def main_handler(message: types.Message, state: FSMContext):
 
     # Payment cancel
     if current_state == 'UserStates:waiting_for_payment':
-        if text == LANGS[l]['cancel']:
+        if action == 'cancel':
             await state.finish()
             await show_main_menu(message, l)
         return
 
     # Admin broadcast state
     if current_state == 'AdminStates:waiting_for_broadcast':
-        if text == LANGS[l]['cancel']:
-            await state.finish()
+        await state.finish()
+        if action == 'cancel':
             await message.answer(LANGS[l]['broadcast_canceled'])
             return
-        all_users     = await db.get_all_users()
-        success_count = 0
-        for u in all_users:
-            try:
-                await bot.send_message(u['id'], text, parse_mode="Markdown")
-                success_count += 1
-                await asyncio.sleep(0.05)
-            except Exception as e:
-                logger.error(f"Broadcast xato {u['id']}: {e}")
-        await message.answer(LANGS[l]['broadcast_sent'].format(count=success_count))
-        await state.finish()
+        if uid == ADMIN_ID:
+            await start_broadcast(message, l)
         return
 
     # Asosiy menu
-    if text == btns[0]:  # Tariflar
-        package_btns = LANGS[l]['package_btns']
-        kb = ReplyKeyboardMarkup(resize_keyboard=True).add(
-            KeyboardButton(package_btns[0]), KeyboardButton(package_btns[1])
-        ).add(KeyboardButton(package_btns[2])).add(KeyboardButton(LANGS[l]['cancel']))
-        await message.answer(LANGS[l]['tarif'], reply_markup=kb)
+    if action == 'tariffs':
+        await message.answer(LANGS[l]['tarif'], reply_markup=TARIF_KB[l])
         await UserStates.waiting_package_choice.set()
 
-    elif text == btns[1]:  # Kabinet
+    elif action == 'profile':
         status    = "⭐ VIP PREMIUM" if user['is_premium'] else "👤 Oddiy"
         ref_count = await db.get_referral_count(uid)
+        name      = user['first_name'] or message.from_user.first_name
+        date      = user['created_at'].strftime('%d.%m.%Y') if user['created_at'] else "—"
         await message.answer(
           f"📊 **SHAXSIY KABINET**\n\n"
           f"👤 Ism: {name}\n"
@@ -606,60 +2907,44 @@ async def main_handler(message: types.Message, state: FSMContext):
           f"📅 Ro'yxatdan o'tgan: {date}"
         )
 
-    elif text == btns[2]:  # Taklif
-        bot_me = await bot.get_me()
-        link   = f"https://t.me/{bot_me.username}?start={uid}"
-        count  = await db.get_referral_count(uid)
-        kb = ReplyKeyboardMarkup(resize_keyboard=True).add(
-            KeyboardButton("📤 Ulashish")
-        ).add(KeyboardButton(LANGS[l]['cancel']))
+    elif action == 'invite':
+        link  = await referral_link(uid)
+        count = await db.get_referral_count(uid)
         await message.answer(
             LANGS[l]['ref_text'] +
             f"🔥 Har bir do'stingiz uchun **+1 BEPUL slayd**!\n\n"
             f"🔗 Havolangiz:\n{link}\n\n"
             f"👥 Taklif qilingan: **{count} ta**",
-            reply_markup=kb
+            reply_markup=INVITE_KB[l]
         )
 
-    elif text == btns[3]:  # Qo'llanma
+    elif action == 'guide':
         await message.answer(LANGS[l]['help_text'])
 
-    elif text == btns[4]:  # Til
-        ikb = InlineKeyboardMarkup().add(
-            InlineKeyboardButton("🇺🇿 O'zbekcha", callback_data="lang_uz")
-        ).add(
-            InlineKeyboardButton("🇷🇺 Русский", callback_data="lang_ru")
-        ).add(
-            InlineKeyboardButton("🇬🇧 English", callback_data="lang_en")
-        )
-        await message.answer("Tilni tanlang / Select language:", reply_markup=ikb)
+    elif action == 'language':
+        await message.answer("Tilni tanlang / Select language:", reply_markup=LANG_IKB)
 
-    elif text == "📤 Ulashish":
-        bot_me = await bot.get_me()
-        link   = f"https://t.me/{bot_me.username}?start={uid}"
+    elif action == 'share':
+        link = await referral_link(uid)
         await message.answer(f"🔗 Taklif havolangiz:\n\n`{link}`")
 
-    elif text == LANGS[l]['cancel']:
+    elif action == 'cancel':
         await state.finish()
         await show_main_menu(message, l)
 
     elif text == "/admin" and uid == ADMIN_ID:
-        ikb = InlineKeyboardMarkup().add(
-            InlineKeyboardButton("📊 Statistika", callback_data="admin_stats"),
-            InlineKeyboardButton("📢 Broadcast",  callback_data="admin_broadcast")
-        )
-        await message.answer(LANGS[l]['admin_panel'], reply_markup=ikb)
+        await message.answer(LANGS[l]['admin_panel'], reply_markup=ADMIN_IKB)
 
-    else:  # Slayd mavzusi
+    else:  # Slayd mavzusi (ro'yxat — paket)
         if not user['is_premium'] and user['balance'] <= 0:
             return await message.answer(LANGS[l]['no_bal'])
+        topics = split_topics(text)
+        if len(topics) > 1:
+            await state.update_data(topics=topics)
+            return await message.answer(LANGS[l]['batch_prompt'].format(count=len(topics)),
+                                        reply_markup=BATCH_IKB)
         await state.update_data(topic=text)
-        ikb = InlineKeyboardMarkup().add(
-            InlineKeyboardButton("📄 7 slayd",  callback_data="gen:7"),
-            InlineKeyboardButton("📄 10 slayd", callback_data="gen:10"),
-            InlineKeyboardButton("📄 15 slayd", callback_data="gen:15")
-        )
-        await message.answer(LANGS[l]['gen_prompt'].format(topic=text), reply_markup=ikb)
+        await message.answer(LANGS[l]['gen_prompt'].format(topic=text), reply_markup=GEN_IKB)
 
 @dp.message_handler(content_types=['photo', 'document'], state=UserStates.waiting_for_payment)
 async def process_payment_screenshot(message: types.Message, state: FSMContext):
@@ -670,6 +2955,7 @@ async def process_payment_screenshot(message: types.Message, state: FSMContext):
 
     file_id = message.photo[-1].file_id if message.photo else message.document.file_id
     pid     = await db.add_payment(uid, data.get('amount'), data.get('chosen_package'), file_id)
+    PAYMENTS.inc(package=data.get('chosen_package'))
 
     if ADMIN_ID:
         try:
@@ -691,6 +2977,15 @@ async def process_payment_screenshot(message: types.Message, state: FSMContext):
     await state.finish()
     await show_main_menu(message, l)
 
+@dp.message_handler(content_types=['photo', 'video', 'animation', 'document'],
+                    state=AdminStates.waiting_for_broadcast)
+async def broadcast_media(message: types.Message, state: FSMContext):
+    await state.finish()
+    if message.from_user.id != ADMIN_ID:
+        return
+    admin = await db.get_user(message.from_user.id)
+    await start_broadcast(message, admin['lang'] if admin else 'uz')
+
 @dp.callback_query_handler(lambda c: c.data.startswith('gen:'), state='*')
 async def generate_slides(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
@@ -702,47 +2997,35 @@ async def generate_slides(callback: CallbackQuery, state: FSMContext):
     l          = user['lang']
     data       = await state.get_data()
     topic      = data.get('topic')
-    num_slides = int(callback.data.split(":")[1])
+    value      = callback.data.split(":", 1)[1]
+    num_slides = int(value) if value.isdigit() else 0
 
-    if not topic:
+    if not topic or num_slides not in GEN_OPTIONS:
         return await callback.message.answer(LANGS[l]['error'])
 
-    if not user['is_premium']:
-        if user['balance'] < num_slides:
-            return await callback.message.answer(LANGS[l]['no_bal'])
-        await db.update_balance(uid, -num_slides)
+    job = GenJob(uid, l, bool(user['is_premium']), topic, num_slides, 0, callback.message)
+    await enqueue_job(job, num_slides)
 
-    wait_msg = await callback.message.answer(LANGS[l]['wait'])
+@dp.callback_query_handler(lambda c: c.data.startswith('batch:'), state='*')
+async def generate_batch(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
+    uid  = callback.from_user.id
+    user = await db.get_user(uid)
+    if not user:
+        return
 
-    try:
-        prompt = (
-            f'Create a presentation on: "{topic}". '
-            f'Return ONLY valid JSON: {{"slides":[{{"title":"...","points":["..."]}}]}} '
-            f'Generate exactly {num_slides} slides. No extra text.'
-        )
-        response = await client.chat.completions.create(
-            model="llama3-8b-8192",
-            messages=[
-                {"role": "system", "content": "You are a presentation creator. Return valid JSON only."},
-                {"role": "user",   "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=4000
-        )
-        json_response = response.choices[0].message.content
-        file_path     = create_presentation_file(topic, json_response, uid)
+    l          = user['lang']
+    data       = await state.get_data()
+    topics     = data.get('topics')
+    value      = callback.data.split(":", 1)[1]
+    num_slides = int(value) if value.isdigit() else 0
 
-        with open(file_path, 'rb') as f:
-            await callback.message.answer_document(f, caption=LANGS[l]['done'])
-        await wait_msg.delete()
-        remove_file(file_path)
+    if not topics or num_slides not in BATCH_OPTIONS:
+        return await callback.message.answer(LANGS[l]['error'])
 
-    except Exception as e:
-        logger.error(f"AI xato: {e}", exc_info=True)
-        if not user['is_premium']:
-            await db.update_balance(uid, num_slides)
-        await callback.message.answer(LANGS[l]['error'])
-        await wait_msg.delete()
+    # Butun paket narxi bitta tranzaksiyada yechiladi
+    job = BatchJob(uid, l, bool(user['is_premium']), topics, num_slides, 0, callback.message)
+    await enqueue_job(job, num_slides * len(topics))
 
 @dp.callback_query_handler(lambda c: c.data.startswith('admin_'), state='*')
 async def admin_callback(callback: CallbackQuery, state: FSMContext):
@@ -752,62 +3035,237 @@ async def admin_callback(callback: CallbackQuery, state: FSMContext):
 
     if callback.data == "admin_stats":
         stats = await db.get_stats()
+        cache = db.users.stats()
+        oc    = outline_cache.mem.stats()
         await callback.answer()
         await callback.message.answer(
             f"📊 **Bot statistikasi**\n\n"
             f"👥 Foydalanuvchilar: {stats['total_users']}\n"
             f"💰 Jami balans: {stats['total_slides']}\n"
-            f"👑 Premium: {stats['premium_users']}"
+            f"👑 Premium: {stats['premium_users']}\n\n"
+            f"🗄 Kesh: {cache['hits']} hit / {cache['misses']} miss ({cache['size']} ta)\n"
+            f"🧠 Outline kesh: {oc['hits']} hit / {oc['misses']} miss ({oc['size']} ta)\n\n"
+            f"📈 Oxirgi {STATS_DAYS} kun:\n" + stats_dashboard(
+                await db.get_daily_stats(STATS_DAYS), STATS_DAYS, await db.current_date()),
+            reply_markup=STATS_IKB
+        )
+    elif callback.data == "admin_export":
+        await callback.answer()
+        content = stats_csv(await db.get_daily_stats(STATS_EXPORT_DAYS))
+        await callback.message.answer_document(
+            InputFile(io.BytesIO(content), filename=f"stats_{datetime.now():%Y%m%d}.csv"),
+            caption=f"📥 Kunlik statistika ({STATS_EXPORT_DAYS} kun)")
+    elif callback.data == "admin_ledger":
+        await callback.answer()
+        day   = {r['reason']: r for r in await db.get_ledger_totals(days=1)}
+        total = await db.get_ledger_totals()
+        lines = [f"• {r['reason']}: {r['total']:+} ({r['cnt']} ta) | 24h: "
+                 f"{day[r['reason']]['total'] if r['reason'] in day else 0:+}" for r in total]
+        await callback.message.answer(
+            "🧾 **Balans ledger**\n\n" + ("\n".join(lines) or "—") +
+            f"\n\n💰 Jami: {sum(r['total'] for r in total)}"
         )
     elif callback.data == "admin_broadcast":
         admin = await db.get_user(uid)
         l     = admin['lang'] if admin else 'uz'
         await AdminStates.waiting_for_broadcast.set()
         await callback.answer()
-        await callback.message.answer(
-            LANGS[l]['broadcast_start'],
-            reply_markup=ReplyKeyboardMarkup(resize_keyboard=True).add(
-                KeyboardButton(LANGS[l]['cancel'])
-            )
-        )
+        await callback.message.answer(LANGS[l]['broadcast_start'], reply_markup=CANCEL_KB[l])
+
+# --- 8. WEBHOOK VA HEALTH CHECK ---
+# Webhook update'lari ichki navbat orqali worker'larga tarqatiladi. Har bir chat
+# o'z "pochta qutisiga" ega: bitta chatning update'lari ketma-ket, turli chatlar
+# esa parallel ishlanadi va sekin chat boshqalarni to'sib qo'ymaydi.
+class UpdateQueue:
+    def __init__(self, dispatcher, workers, max_depth):
+        self.dp        = dispatcher
+        self.workers   = workers
+        self.max_depth = max_depth
+        self.depth     = 0
+        self.shed      = 0
+        self._boxes    = {}   # chat_id -> deque (ishlanayotgan chat uchun ham mavjud)
+        self._ready    = asyncio.Queue()
+        self._tasks    = []
+
+    def offer(self, update):
+        if self.depth >= self.max_depth:
+            self.shed += 1
+            return False
+        key = update_chat_id(update) or update.update_id
+        self.depth += 1
+        box = self._boxes.get(key)
+        if box is None:
+            self._boxes[key] = deque([update])
+            self._ready.put_nowait(key)
+        else:
+            box.append(update)
+        return True
+
+    async def _worker(self):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        while True:
+            key    = await self._ready.get()
+            box    = self._boxes[key]
+            update = box.popleft()
+            try:
+                # updates_handler orqali — pre_process_update middleware'lari ham ishlaydi
+                await self.dp.updates_handler.notify(update)
+            except Exception as e:
+                logger.error(f"Update {update.update_id} xato: {e}", exc_info=True)
+            finally:
+                self.depth -= 1
+                if box:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._boxes[key]
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+            logger.info(f"✅ Update navbati: {self.workers} worker, chegara {self.max_depth}")
+
+    async def stop(self, timeout=UPDATE_DRAIN_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.depth:
+            logger.warning(f"Navbatda {self.depth} ta update ishlanmay qoldi")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+update_queue = UpdateQueue(dp, UPDATE_WORKERS, UPDATE_QUEUE_MAX)
+
+async def webhook_handler(request):
+    if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    try:
+        update = types.Update(**(await request.json()))
+    except Exception:
+        return web.Response(status=400)
+    if not update_queue.offer(update):
+        logger.warning(f"Navbat to'la ({update_queue.depth}), update {update.update_id} tashlandi")
+        if UPDATE_SHED_POLICY == 'retry':
+            return web.Response(status=503)
+    return web.Response(status=200)
+
+async def metrics_handler(request):
+    if not METRICS_TOKEN:
+        return web.Response(status=404)
+    auth  = request.headers.get('Authorization', '')
+    token = auth[7:] if auth.startswith('Bearer ') else request.query.get('token', '')
+    if not hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        return web.Response(status=401)
+    return web.Response(body=render_metrics().encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
 
-# --- 8. HEALTH CHECK ---
 async def health_check(request):
-    return web.Response(text="OK", status=200)
+    db_ok = await db.ping()
+    return web.json_response({
+        'status':      'ok' if db_ok else 'db_unavailable',
+        'queue_depth': update_queue.depth,
+        'queue_max':   update_queue.max_depth,
+        'shed':        update_queue.shed,
+    }, status=200 if db_ok else 503)
 
 # --- 9. STARTUP / SHUTDOWN ---
-async def on_startup(dp):
-    os.makedirs("slides", exist_ok=True)
-    await db.init()
+async def _timed_step(timings, name, aw):
+    started = time.perf_counter()
+    try:
+        return await aw
+    finally:
+        timings[name] = time.perf_counter() - started
+
+async def _setup_webhook():
+    me = await bot.me
+    logger.info(f"🤖 Bot: @{me.username}")
     if WEBHOOK_URL:
-        await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True)
+        await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True, secret_token=WEBHOOK_SECRET)
         logger.info(f"✅ Webhook: {WEBHOOK_URL}")
     else:
         logger.info("🔄 Polling rejimi")
 
+# groq importi alohida thread'da (event loop DB va Telegram so'rovlarini davom ettiradi),
+# so'ng API'ga ulanish ochib qo'yiladi — birinchi generatsiya TLS handshake kutmaydi.
+# Startup buni kutmaydi: update'larni qabul qilish uchun Groq kerak emas.
+warmup_task = None
+
+async def _warm_groq():
+    started = time.perf_counter()
+    try:
+        client = await asyncio.get_running_loop().run_in_executor(None, groq_client)
+        await asyncio.wait_for(client.models.list(), timeout=10)
+        logger.info(f"🧠 Groq tayyor: {time.perf_counter() - started:.2f}s")
+    except Exception as e:
+        logger.warning(f"Groq oldindan ulanmadi: {e}")
+
+async def on_startup(dp):
+    timings = {'import': _BOOT_IMPORTED - _BOOT_T0}
+    started = time.perf_counter()
+    global warmup_task
+    warmup_task = asyncio.ensure_future(_warm_groq())
+    # Mustaqil bosqichlar parallel: DB (pool + sxema tekshiruvi) va webhook
+    await asyncio.gather(
+        _timed_step(timings, 'db', db.init()),
+        _timed_step(timings, 'webhook', _setup_webhook()),
+    )
+    db.start_listener()
+    render_pool.start()
+    outline_cache.open()
+    gen_scheduler.start()
+    activity.start()
+    storage.start()
+    await _timed_step(timings, 'broadcasts', resume_broadcasts())
+    if WEBHOOK_URL:
+        update_queue.start()
+    timings['startup'] = time.perf_counter() - started
+    logger.info(f"🚀 Ishga tushdi: {time.perf_counter() - _BOOT_T0:.2f}s (" +
+                ", ".join(f"{k} {v:.2f}s" for k, v in timings.items()) + ")")
+
 async def on_shutdown(dp):
+    # Polling rejimida executor on_shutdown'ni polling to'xtashidan oldin chaqiradi —
+    # yopilayotgan pool'ga yangi update'lar kelmasligi uchun avval to'xtatamiz
+    dp.stop_polling()
+    if warmup_task is not None:
+        warmup_task.cancel()
     await bot.delete_webhook()
+    await update_queue.stop()
+    await stop_broadcasts()
+    await gen_scheduler.stop()
+    await activity.stop()
+    await storage.close()
+    render_pool.shutdown()
+    outline_cache.close()
+    await db.close()
     logger.info("🛑 Bot to'xtatildi.")
 
 # --- 10. MAIN ---
+async def _app_startup(app):
+    # Fon vazifalari (navbat, broadcast) shu kontekstni meros oladi — message.answer() uchun kerak
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    await on_startup(dp)
+
+async def _app_shutdown(app):
+    await on_shutdown(dp)
+    session = await bot.get_session()
+    await session.close()
+
+def create_app():
+    app = web.Application()
+    app.router.add_get('/', health_check)
+    app.router.add_get('/health', health_check)
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    app.on_startup.append(_app_startup)
+    app.on_shutdown.append(_app_shutdown)
+    return app
+
 if __name__ == "__main__":
     if WEBHOOK_URL:
-        app = web.Application()
-        app.router.add_get('/', health_check)
-        app.router.add_get('/health', health_check)
-
-        from aiogram.webhook.aiohttp_server import SimpleRequestHandler
-        # aiogram 2.x uchun
-        from aiogram.utils.executor import start_webhook
-        start_webhook(
-            dispatcher=dp,
-            webhook_path=WEBHOOK_PATH,
-            on_startup=on_startup,
-            on_shutdown=on_shutdown,
-            skip_updates=True,
-            host="0.0.0.0",
-            port=PORT,
-        )
+        web.run_app(create_app(), host="0.0.0.0", port=PORT)
     else:
         from aiogram import executor
-        executor.start_polling(dp, on_startup=on_startup, skip_updates=True)
+        executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown, skip_updates=True)
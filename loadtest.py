@@ -0,0 +1,674 @@
+# Slide Master AI Bot — webhook yuklama testi
+#
+# Telegram Bot API va Groq o'rniga lokal mock HTTP serverlar ishga tushiriladi
+# (kechikish va xato ulushi sozlanadi), bot esa alohida jarayonda webhook rejimida
+# shu mock'larga ulanadi. Generator real update'larni (/start referal bilan, menyu
+# tugmalari, gen: callback, to'lov cheki, admin broadcast) berilgan tezlikda
+# webhook'ga POST qiladi va bot javobi mock Telegram'ga kelguncha vaqtni o'lchaydi.
+#
+#   DATABASE_URL=postgresql://... python loadtest.py --rates 5,10,20,40 --step 30
+#   python loadtest.py --target http://127.0.0.1:10000/webhook --secret ...   # tayyor bot
+#
+# Tayyor botni o'lchashda u TELEGRAM_API_URL va GROQ_BASE_URL orqali shu skript
+# ko'rsatgan mock manzillarga ulangan bo'lishi kerak (--tg-port, --groq-port).
+# Sinov foydalanuvchilari alohida ID oralig'ida yaratiladi (--uid-base, admin — oraliqning
+# birinchi ID'si), --cleanup bilan oxirida o'chiriladi. Ishlab chiqarish bazasida ishlatmang.
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import asyncio
+import argparse
+import subprocess
+from collections import deque, Counter
+
+BOT_ENV = dict(os.environ)   # bot jarayoniga uzatiladigan asl muhit
+
+# LANGS matnlarini bot.py'dan olamiz (import paytidagi env tekshiruvi uchun)
+os.environ.setdefault('BOT_TOKEN', '123456:LOADTESTLOADTESTLOADTESTLOADTEST')
+os.environ.setdefault('GROQ_API_KEY', 'loadtest')
+os.environ.setdefault('DATABASE_URL', 'postgresql://loadtest@localhost/loadtest')
+
+import logging
+logging.disable(logging.WARNING)
+
+import asyncpg
+from aiohttp import web, ClientSession, ClientTimeout
+
+from bot import LANGS, SQL_BUMP_STATS
+
+T = LANGS['uz']
+
+def prefix(text):
+    return text.split('{')[0][:24]
+
+def chat_of(data):
+    value = str(data.get('chat_id', ''))
+    return int(value) if value.lstrip('-').isdigit() else 0   # '@kanal' kabi
+
+# --- MOCK SERVERLAR ---
+class MockBase:
+    def __init__(self, latency, error_rate, rng):
+        self.latency    = latency
+        self.error_rate = error_rate
+        self.rng        = rng
+        self.requests   = Counter()
+        self.errors     = 0
+
+    async def delay(self, latency=None):
+        latency = self.latency if latency is None else latency
+        if latency > 0:
+            await asyncio.sleep(latency * self.rng.uniform(0.5, 1.5))
+
+    def fail(self):
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+# Bot javoblarini kutayotgan qadamlar: chat bo'yicha (matn prefiksi bilan),
+# callback id bo'yicha va hujjat (taqdimot) bo'yicha
+class ReplyTracker:
+    def __init__(self):
+        self.chats     = {}   # chat_id -> deque[(prefix, future)]
+        self.callbacks = {}   # callback_query_id -> future
+        self.documents = {}   # chat_id -> future
+        self.delivered = 0    # broadcast copyMessage soni
+
+    def _future(self):
+        return asyncio.get_running_loop().create_future()
+
+    def expect_message(self, chat_id, text_prefix=None):
+        fut = self._future()
+        self.chats.setdefault(chat_id, deque()).append((text_prefix, fut))
+        return fut
+
+    def expect_callback(self, callback_id):
+        fut = self.callbacks[callback_id] = self._future()
+        return fut
+
+    def expect_document(self, chat_id):
+        fut = self.documents[chat_id] = self._future()
+        return fut
+
+    def forget(self, fut):
+        for box in self.chats.values():
+            for item in list(box):
+                if item[1] is fut:
+                    box.remove(item)
+
+    @staticmethod
+    def _resolve(fut):
+        if fut is not None and not fut.done():
+            fut.set_result(time.monotonic())
+
+    def on_request(self, method, data):
+        if method == 'answerCallbackQuery':
+            self._resolve(self.callbacks.pop(data.get('callback_query_id'), None))
+        elif method == 'copyMessage':
+            self.delivered += 1
+        elif method in ('sendMessage', 'sendDocument'):
+            chat_id = chat_of(data)
+            if method == 'sendDocument':
+                self._resolve(self.documents.pop(chat_id, None))
+                return
+            box  = self.chats.get(chat_id)
+            text = data.get('text', '')
+            for item in list(box or ()):
+                if item[0] is None or text.startswith(item[0]):
+                    box.remove(item)
+                    self._resolve(item[1])
+                    break
+
+class MockTelegram(MockBase):
+    def __init__(self, tracker, latency, error_rate, rng):
+        super().__init__(latency, error_rate, rng)
+        self.tracker    = tracker
+        self.message_id = 0
+
+    def _message(self, chat_id, text=''):
+        self.message_id += 1
+        return {'message_id': self.message_id, 'date': int(time.time()), 'text': text,
+                'chat': {'id': chat_id, 'type': 'private'}}
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        data   = dict(await request.post())
+        self.requests[method] += 1
+        await self.delay()
+        if method not in ('setWebhook', 'deleteWebhook', 'getMe') and self.fail():
+            if self.rng.random() < 0.5:
+                return web.json_response({'ok': False, 'error_code': 429,
+                                          'description': 'Too Many Requests: retry after 1',
+                                          'parameters': {'retry_after': 1}}, status=429)
+            return web.json_response({'ok': False, 'error_code': 500,
+                                      'description': 'Internal Server Error'}, status=500)
+        self.tracker.on_request(method, data)
+
+        chat_id = chat_of(data)
+        if method == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Load', 'username': 'loadtest_bot'}
+        elif method == 'getChatMember':
+            result = {'status': 'member', 'user': {'id': int(data['user_id']), 'is_bot': False,
+                                                   'first_name': 'Load'}}
+        elif method.startswith('send') or method == 'copyMessage':
+            result = self._message(chat_id, data.get('text', ''))
+            if method == 'sendDocument':
+                result['document'] = {'file_id': f"doc{result['message_id']}",
+                                      'file_unique_id': f"u{result['message_id']}"}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+class MockGroq(MockBase):
+    def __init__(self, latency, error_rate, chunk_delay, rng):
+        super().__init__(latency, error_rate, rng)
+        self.chunk_delay = chunk_delay
+
+    @staticmethod
+    def outline(prompt):
+        topic = prompt.split('"')[1]
+        count = int(prompt.split('Generate exactly ')[1].split()[0])
+        if '"titles"' in prompt:
+            return json.dumps({"titles": [f"{topic}: {i + 1}" for i in range(count)]}, ensure_ascii=False)
+        return json.dumps({"slides": [
+            {"title": f"{topic}: {i + 1}", "points": [f"Muhim fikr {j + 1}" for j in range(4)]}
+            for i in range(count)]}, ensure_ascii=False)
+
+    def _chunk(self, body, model):
+        return {'id': 'chatcmpl-load', 'object': body, 'created': int(time.time()), 'model': model}
+
+    async def handle(self, request):
+        payload = await request.json()
+        self.requests['stream' if payload.get('stream') else 'full'] += 1
+        await self.delay()
+        if self.fail():
+            if self.rng.random() < 0.5:
+                return web.json_response({'error': {'message': 'Rate limit reached', 'type': 'tokens'}},
+                                         status=429, headers={'Retry-After': '1'})
+            return web.json_response({'error': {'message': 'mock overloaded', 'type': 'server_error'}},
+                                     status=503)
+        text  = self.outline(payload['messages'][-1]['content'])
+        model = payload.get('model', 'mock')
+        if not payload.get('stream'):
+            return web.json_response({**self._chunk('chat.completion', model), 'choices': [
+                {'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}]})
+
+        resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await resp.prepare(request)
+        for i in range(0, len(text), 24):
+            chunk = {**self._chunk('chat.completion.chunk', model), 'choices': [
+                {'index': 0, 'delta': {'content': text[i:i + 24]}, 'finish_reason': None}]}
+            await resp.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    async def models(self, request):
+        self.requests['models'] += 1
+        return web.json_response({'object': 'list', 'data': [
+            {'id': 'mock', 'object': 'model', 'created': 0, 'owned_by': 'loadtest'}]})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/openai/v1/chat/completions', self.handle)
+        app.router.add_get('/openai/v1/models', self.models)
+        return app
+
+async def serve(app, port):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    await site.start()
+    return runner
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# --- UPDATE'LAR ---
+class Updates:
+    def __init__(self):
+        self.seq = 0
+
+    def next_id(self):
+        self.seq += 1
+        return self.seq
+
+    def _from(self, uid):
+        return {'id': uid, 'is_bot': False, 'first_name': f"Load{uid % 10000}",
+                'username': f"load{uid}", 'language_code': 'uz'}
+
+    def message(self, uid, text=None, photo=False):
+        msg = {'message_id': self.next_id(), 'date': int(time.time()),
+               'chat': {'id': uid, 'type': 'private'}, 'from': self._from(uid)}
+        if photo:
+            msg['photo'] = [{'file_id': f"AgADload{self.seq}", 'file_unique_id': f"u{self.seq}",
+                             'width': 640, 'height': 480}]
+        else:
+            msg['text'] = text
+            if text.startswith('/'):
+                msg['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': self.next_id(), 'message': msg}
+
+    def callback(self, uid, data):
+        cb_id = str(self.next_id())
+        return cb_id, {'update_id': self.next_id(), 'callback_query': {
+            'id': cb_id, 'chat_instance': str(uid), 'data': data, 'from': self._from(uid),
+            'message': {'message_id': 1, 'date': int(time.time()), 'text': '-',
+                        'chat': {'id': uid, 'type': 'private'}}}}
+
+# --- YUKLAMA ---
+class StepFailed(Exception):
+    pass
+
+class LoadRunner:
+    def __init__(self, session, target, secret, tracker, args, rng):
+        self.session  = session
+        self.target   = target
+        self.secret   = secret
+        self.tracker  = tracker
+        self.args     = args
+        self.rng      = rng
+        self.updates  = Updates()
+        self.idle     = deque()   # scenariy kutayotgan foydalanuvchilar
+        self.referrers = []       # faqat referal uchun (javoblari o'lchovga aralashmasin)
+        self.next_uid = args.uid_base
+        self.admin_busy = False
+        self.samples  = None
+        self.errors   = None
+
+    async def post(self, update):
+        async with self.session.post(self.target, json=update,
+                                     headers={'X-Telegram-Bot-Api-Secret-Token': self.secret}) as r:
+            if r.status != 200:
+                raise StepFailed(f"http_{r.status}")
+
+    async def wait(self, kind, fut, started, timeout):
+        try:
+            done_at = await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            self.tracker.forget(fut)
+            raise StepFailed(f"{kind}_timeout")
+        self.samples.setdefault(kind, []).append(done_at - started)
+
+    async def step_message(self, kind, uid, text, expect, photo=False):
+        fut     = self.tracker.expect_message(uid, expect)
+        started = time.monotonic()
+        try:
+            await self.post(self.updates.message(uid, text, photo=photo))
+        except BaseException:
+            self.tracker.forget(fut)
+            raise
+        await self.wait(kind, fut, started, self.args.timeout)
+
+    async def step_callback(self, kind, uid, data, document=False):
+        cb_id, update = self.updates.callback(uid, data)
+        fut = self.tracker.expect_callback(cb_id)
+        doc = self.tracker.expect_document(uid) if document else None
+        started = time.monotonic()
+        try:
+            await self.post(update)
+        except BaseException:
+            self.tracker.callbacks.pop(cb_id, None)
+            self.tracker.documents.pop(uid, None)
+            raise
+        await self.wait(kind, fut, started, self.args.timeout)
+        if doc is not None:
+            await self.wait('document', doc, started, self.args.gen_timeout)
+
+    def new_uid(self):
+        self.next_uid += 1
+        return self.next_uid
+
+    # Scenariylar
+    async def sc_start(self, uid):
+        uid = self.new_uid()
+        ref = self.rng.choice(self.referrers) if self.referrers else ''
+        await self.step_message('start', uid, f"/start {ref}".strip(), prefix(T['welcome']))
+        return uid
+
+    async def sc_menu(self, uid):
+        choice = self.rng.choice(('profile', 'invite', 'guide', 'language', 'tariffs'))
+        if choice == 'profile':
+            await self.step_message('menu', uid, T['btns'][1], "📊 **SHAXSIY KABINET**")
+        elif choice == 'invite':
+            await self.step_message('menu', uid, T['btns'][2], prefix(T['ref_text']))
+        elif choice == 'guide':
+            await self.step_message('menu', uid, T['btns'][3], prefix(T['help_text']))
+        elif choice == 'language':
+            await self.step_message('menu', uid, T['btns'][4], "Tilni tanlang")
+        else:
+            await self.step_message('menu', uid, T['btns'][0], prefix(T['tarif']))
+            await self.step_message('menu', uid, T['cancel'], prefix(T['welcome']))
+        return uid
+
+    async def sc_generate(self, uid):
+        topic = self.rng.choice(("Quyosh tizimi", "Sun'iy intellekt", "Amir Temur", "Suv aylanishi",
+                                 "Iqtisodiyot asoslari", "Fotosintez")) + f" {self.rng.randint(1, 10 ** 6)}"
+        await self.step_message('topic', uid, topic, prefix(T['gen_prompt']))
+        await self.step_callback('gen_ack', uid, f"gen:{self.args.slides}", document=True)
+        return uid
+
+    async def sc_payment(self, uid):
+        await self.step_message('payment', uid, T['btns'][0], prefix(T['tarif']))
+        await self.step_message('payment', uid, self.rng.choice(T['package_btns']), "💳 To'lov summasi")
+        await self.step_message('payment', uid, None, prefix(T['payment_sent']), photo=True)
+        return uid
+
+    async def sc_broadcast(self, uid):
+        if self.admin_busy:
+            raise StepFailed('admin_busy')
+        self.admin_busy = True
+        try:
+            await self.step_callback('broadcast', self.args.uid_base, 'admin_broadcast')
+            await self.step_message('broadcast', self.args.uid_base, f"Loadtest {self.updates.seq}",
+                                    prefix(T['broadcast_progress']))
+        finally:
+            self.admin_busy = False
+        return uid
+
+    async def scenario(self, name):
+        uid = None
+        if name not in ('start', 'broadcast'):
+            if not self.idle:
+                self.errors['no_idle_user'] += 1
+                return
+            uid = self.idle.popleft()
+        try:
+            uid = await getattr(self, f"sc_{name}")(uid)
+        except StepFailed as e:
+            self.errors[str(e)] += 1
+            return   # javobsiz qolgan foydalanuvchi boshqa ishlatilmaydi
+        except Exception as e:
+            self.errors[type(e).__name__] += 1
+            return
+        if uid is not None:
+            await asyncio.sleep(self.args.think)   # kechikkan qo'shimcha javoblar keyingi qadamga aralashmasin
+            self.idle.append(uid)
+
+    async def setup_users(self):
+        self.samples, self.errors = {}, Counter()
+        sem = asyncio.Semaphore(20)
+
+        async def one(uid, into):
+            async with sem:
+                await self.step_message('setup', uid, "/start", prefix(T['welcome']))
+                into.append(uid)
+
+        referrers = [self.new_uid() for _ in range(max(1, self.args.users // 10))]
+        users     = [self.new_uid() for _ in range(self.args.users)]
+        await asyncio.gather(*(one(uid, self.referrers) for uid in referrers),
+                             one(self.args.uid_base, []), return_exceptions=True)
+        await asyncio.gather(*(one(uid, self.idle) for uid in users), return_exceptions=True)
+        print(f"👥 Tayyor: {len(self.idle)} foydalanuvchi, {len(self.referrers)} referrer")
+
+    async def run_step(self, rate, duration, mix):
+        self.samples, self.errors = {}, Counter()
+        names, weights = zip(*mix.items())
+        tasks    = []
+        started  = time.monotonic()
+        deadline = started + duration
+        next_at  = started
+        while True:
+            next_at += self.rng.expovariate(rate)   # Poisson oqimi (ochiq tsikl)
+            if next_at >= deadline:
+                break
+            await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+            name = self.rng.choices(names, weights)[0]
+            tasks.append(asyncio.ensure_future(self.scenario(name)))
+        sent_in = time.monotonic() - started
+        await asyncio.gather(*tasks)
+        return {'rate': rate, 'scenarios': len(tasks), 'offered': len(tasks) / sent_in,
+                'wall': time.monotonic() - started, 'samples': self.samples, 'errors': self.errors}
+
+# --- HISOBOT ---
+def pct(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, round(q * (len(values) - 1)))]
+
+def summarize(step, slo):
+    interactive = [v for k, v in step['samples'].items() if k != 'document' for v in v]
+    completed   = sum(len(v) for k, v in step['samples'].items() if k != 'document')
+    failed      = sum(step['errors'].values())
+    step['p50'] = pct(interactive, 0.50)
+    step['p95'] = pct(interactive, 0.95)
+    step['p99'] = pct(interactive, 0.99)
+    step['error_rate'] = failed / max(1, completed + failed)
+    step['saturated']  = (step['p99'] > slo or step['error_rate'] > 0.01
+                          or step['offered'] < step['rate'] * 0.9)
+    return step
+
+def print_step(step):
+    print(f"\n⏱ {step['rate']:g} scenariy/s: {step['scenarios']} scenariy, {step['wall']:.1f}s, "
+          f"p50={step['p50'] * 1000:.0f}ms p95={step['p95'] * 1000:.0f}ms p99={step['p99'] * 1000:.0f}ms, "
+          f"xato={step['error_rate']:.1%}{'  ⚠️ SATURATSIYA' if step['saturated'] else ''}")
+    for kind, values in sorted(step['samples'].items()):
+        print(f"   {kind:<10} n={len(values):<6} p50={pct(values, .5) * 1000:>8.0f}ms "
+              f"p95={pct(values, .95) * 1000:>8.0f}ms p99={pct(values, .99) * 1000:>8.0f}ms")
+    if step['errors']:
+        print("   xatolar: " + ", ".join(f"{k}={v}" for k, v in step['errors'].most_common()))
+
+# --- BOT JARAYONI ---
+def spawn_bot(args, bot_port, tg_port, groq_port, secret):
+    if not BOT_ENV.get('DATABASE_URL'):
+        sys.exit("❌ DATABASE_URL kerak (sinov bazasi)")
+    env = {**BOT_ENV,
+           'BOT_TOKEN':           BOT_ENV.get('BOT_TOKEN', '123456:LOADTESTLOADTESTLOADTESTLOADTEST'),
+           'GROQ_API_KEY':        'loadtest',
+           'ADMIN_ID':            str(args.uid_base),   # admin ham sinov oralig'ida
+           'PORT':                str(bot_port),
+           'RENDER_EXTERNAL_URL': f"http://127.0.0.1:{bot_port}",
+           'WEBHOOK_SECRET':      secret,
+           'TELEGRAM_API_URL':    f"http://127.0.0.1:{tg_port}",
+           'GROQ_BASE_URL':       f"http://127.0.0.1:{groq_port}",
+           # Sig'im o'lchanadi, suiiste'mol himoyasi emas (THROTTLE_ENABLED=1 bilan yoqiladi)
+           'THROTTLE_ENABLED':    BOT_ENV.get('THROTTLE_ENABLED', '0')}
+    log = open(args.bot_log, 'w')
+    here = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.Popen([sys.executable, os.path.join(here, 'bot.py')], env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+def stop_bot(proc):
+    if proc is None or proc.poll() is not None:
+        return
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+async def wait_healthy(session, health_url, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            sys.exit("❌ Bot jarayoni to'xtadi, logni ko'ring")
+        try:
+            async with session.get(health_url) as r:
+                if r.status == 200:
+                    return
+        except Exception:
+            pass
+        await asyncio.sleep(0.5)
+    sys.exit("❌ Bot /health javob bermadi")
+
+async def prepare_db(args):
+    # Generatsiya balans tugagani uchun to'xtab qolmasligi — sinov foydalanuvchilariga katta balans
+    conn = await asyncpg.connect(BOT_ENV['DATABASE_URL'],
+                                 ssl=None if BOT_ENV.get('DB_SSL') == 'disable' else BOT_ENV.get('DB_SSL'))
+    try:
+        await conn.execute("""
+            WITH upd AS (
+                UPDATE users SET balance = balance + 1000000
+                WHERE id >= $1 AND id <= $1 + 100000000 RETURNING id, balance
+            ), led AS (
+                INSERT INTO balance_ledger (user_id, delta, balance_after, reason)
+                SELECT id, 1000000, balance, 'loadtest' FROM upd RETURNING delta
+            )
+            INSERT INTO daily_stats (day, metric, key, value)
+            SELECT CURRENT_DATE, 'ledger', 'loadtest', SUM(delta) FROM led HAVING COUNT(*) > 0
+        """ + SQL_BUMP_STATS, args.uid_base)
+    finally:
+        await conn.close()
+
+# O'chiriladigan qatorlar daily_stats'ga qo'shgan hissa ayirib tashlanadi (get_stats va
+# admin paneli shu hisoblagichlarni o'qiydi). Tayyor taqdimotlar: to'liq qaytarilmagan
+# 'generation' yechimlari (premium'siz sinov foydalanuvchilari uchun aniq).
+SQL_UNDO_STATS = """
+    INSERT INTO daily_stats (day, metric, key, value)
+    SELECT day, metric, key, -value FROM (
+        SELECT COALESCE(created_at::date, CURRENT_DATE) AS day, 'signups' AS metric,
+               '' AS key, COUNT(*)::bigint AS value
+        FROM users WHERE id BETWEEN $1 AND $2 GROUP BY 1
+        UNION ALL
+        SELECT COALESCE(created_at::date, CURRENT_DATE), 'referrals', '', COUNT(*)
+        FROM referrals WHERE referred_id BETWEEN $1 AND $2 GROUP BY 1
+        UNION ALL
+        SELECT COALESCE(created_at::date, CURRENT_DATE), 'ledger', reason, SUM(delta)
+        FROM balance_ledger WHERE user_id BETWEEN $1 AND $2 GROUP BY 1, 3
+        UNION ALL
+        SELECT COALESCE(created_at::date, CURRENT_DATE), 'payments', COALESCE(package_type, ''), COUNT(*)
+        FROM payments WHERE user_id BETWEEN $1 AND $2 GROUP BY 1, 3
+        UNION ALL
+        SELECT COALESCE(created_at::date, CURRENT_DATE), 'revenue', COALESCE(package_type, ''),
+               COALESCE(SUM(amount), 0)
+        FROM payments WHERE user_id BETWEEN $1 AND $2 GROUP BY 1, 3
+        UNION ALL
+        SELECT CURRENT_DATE, 'premium', '', COUNT(*)
+        FROM users WHERE id BETWEEN $1 AND $2 AND is_premium = 1
+        UNION ALL
+        SELECT COALESCE(g.created_at::date, CURRENT_DATE), 'generations', 'regular', COUNT(*)
+        FROM balance_ledger g
+        WHERE g.user_id BETWEEN $1 AND $2 AND g.reason = 'generation' AND NOT EXISTS (
+            SELECT 1 FROM balance_ledger r
+            WHERE r.user_id = g.user_id AND r.reason = 'refund' AND r.ref = g.ref
+              AND r.delta = -g.delta AND r.id > g.id)
+        GROUP BY 1
+    ) s
+    WHERE value <> 0
+""" + SQL_BUMP_STATS
+
+async def cleanup_db(args):
+    conn = await asyncpg.connect(BOT_ENV['DATABASE_URL'],
+                                 ssl=None if BOT_ENV.get('DB_SSL') == 'disable' else BOT_ENV.get('DB_SSL'))
+    lo, hi = args.uid_base, args.uid_base + 100000000
+    try:
+        async with conn.transaction():
+            await conn.execute(SQL_UNDO_STATS, lo, hi)
+            await conn.execute("DELETE FROM referrals WHERE referred_id BETWEEN $1 AND $2", lo, hi)
+            await conn.execute("DELETE FROM payments WHERE user_id BETWEEN $1 AND $2", lo, hi)
+            await conn.execute("DELETE FROM balance_ledger WHERE user_id BETWEEN $1 AND $2", lo, hi)
+            await conn.execute("DELETE FROM fsm_states WHERE user_id BETWEEN $1 AND $2", lo, hi)
+            await conn.execute("DELETE FROM broadcasts WHERE admin_id = $1", lo)
+            await conn.execute("DELETE FROM users WHERE id BETWEEN $1 AND $2", lo, hi)
+    finally:
+        await conn.close()
+    print("🧹 Sinov foydalanuvchilari o'chirildi")
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('start', 'menu', 'generate', 'payment', 'broadcast'):
+            raise argparse.ArgumentTypeError(f"noma'lum scenariy: {name}")
+        if float(weight) > 0:
+            mix[name] = float(weight)
+    return mix
+
+async def main(args):
+    rng     = random.Random(args.seed)
+    tracker = ReplyTracker()
+    tg      = MockTelegram(tracker, args.tg_latency, args.tg_error_rate, rng)
+    groq    = MockGroq(args.groq_latency, args.groq_error_rate, args.groq_chunk_delay, rng)
+    runners = [await serve(tg.app(), args.tg_port), await serve(groq.app(), args.groq_port)]
+    print(f"🧪 Mock Telegram: 127.0.0.1:{args.tg_port}, mock Groq: 127.0.0.1:{args.groq_port}")
+
+    proc, secret = None, args.secret or 'loadtest-secret'
+    if args.target:
+        target = args.target
+    else:
+        bot_port = free_port()
+        target   = f"http://127.0.0.1:{bot_port}/webhook"
+        proc     = spawn_bot(args, bot_port, args.tg_port, args.groq_port, secret)
+    health = target.rsplit('/', 1)[0] + '/health'
+
+    steps = []
+    try:
+        async with ClientSession(timeout=ClientTimeout(total=args.timeout)) as session:
+            await wait_healthy(session, health, proc)
+            runner = LoadRunner(session, target, secret, tracker, args, rng)
+            await runner.setup_users()
+            if not args.no_db:
+                await prepare_db(args)
+            for rate in args.rates:
+                step = summarize(await runner.run_step(rate, args.step, args.mix), args.slo)
+                steps.append(step)
+                print_step(step)
+                if step['saturated'] and args.stop_on_saturation:
+                    break
+    finally:
+        stop_bot(proc)
+        for r in runners:
+            await r.cleanup()
+        if args.cleanup and not args.no_db:
+            await cleanup_db(args)
+
+    print(f"\n📨 Telegram so'rovlari: {sum(tg.requests.values())} ({tg.errors} xato kiritildi), "
+          f"broadcast yetkazildi: {tracker.delivered}")
+    print(f"🧠 Groq so'rovlari: {sum(groq.requests.values())} ({groq.errors} xato kiritildi)")
+    ok = [s for s in steps if not s['saturated']]
+    sat = next((s for s in steps if s['saturated']), None)
+    if sat:
+        print(f"📈 Saturatsiya nuqtasi: ~{sat['rate']:g} scenariy/s "
+              f"(oxirgi barqaror: {ok[-1]['rate']:g} scenariy/s)" if ok else
+              f"📈 Birinchi bosqichdayoq saturatsiya: {sat['rate']:g} scenariy/s")
+    else:
+        print(f"📈 Saturatsiyaga yetilmadi (maks. {steps[-1]['rate']:g} scenariy/s)" if steps else "")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump([{**s, 'errors': dict(s['errors']),
+                        'samples': {k: len(v) for k, v in s['samples'].items()}} for s in steps], f, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Slide Master AI Bot — webhook yuklama testi")
+    parser.add_argument('--rates', type=lambda s: [float(x) for x in s.split(',')], default=[2, 5, 10, 20],
+                        help="bosqichlar tezligi, scenariy/soniya")
+    parser.add_argument('--step', type=float, default=30, help="har bir bosqich davomiyligi (s)")
+    parser.add_argument('--mix', type=parse_mix,
+                        default=parse_mix("start=10,menu=50,generate=25,payment=10,broadcast=0.2"))
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--slides', type=int, default=7)
+    parser.add_argument('--think', type=float, default=0.5, help="scenariylar orasida foydalanuvchi pauzasi (s)")
+    parser.add_argument('--timeout', type=float, default=15, help="bitta javob uchun kutish (s)")
+    parser.add_argument('--gen-timeout', type=float, default=120, help="taqdimot fayli uchun kutish (s)")
+    parser.add_argument('--slo', type=float, default=2.0, help="p99 chegarasi (s) — saturatsiya mezoni")
+    parser.add_argument('--stop-on-saturation', action='store_true')
+    parser.add_argument('--tg-port', type=int, default=free_port())
+    parser.add_argument('--tg-latency', type=float, default=0.05)
+    parser.add_argument('--tg-error-rate', type=float, default=0.0)
+    parser.add_argument('--groq-port', type=int, default=free_port())
+    parser.add_argument('--groq-latency', type=float, default=0.5, help="birinchi tokengacha (s)")
+    parser.add_argument('--groq-chunk-delay', type=float, default=0.005)
+    parser.add_argument('--groq-error-rate', type=float, default=0.0)
+    parser.add_argument('--target', help="tayyor botning webhook URL'i (aks holda bot.py ishga tushiriladi)")
+    parser.add_argument('--secret', help="WEBHOOK_SECRET")
+    parser.add_argument('--uid-base', type=int, default=8_000_000_000)
+    parser.add_argument('--no-db', action='store_true', help="bazaga to'g'ridan-to'g'ri ulanmaslik")
+    parser.add_argument('--cleanup', action='store_true', help="oxirida sinov foydalanuvchilarini o'chirish")
+    parser.add_argument('--bot-log', default='loadtest-bot.log')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="natijalarni JSON faylga yozish")
+    asyncio.run(main(parser.parse_args()))